@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Чистые хелперы форматирования (без БД/Telegram) — вызываются на каждую задачу в списках
+и дайджесте. Модуль можно собрать mypyc в C-расширение: `mypyc formatters.py`
+(в Docker: --build-arg MYPYC=1); без сборки импортируется как обычный .py.
+
+Задача `t` — Task или Row с теми же атрибутами (TASK_VIEW_COLS в tasks_bot).
+"""
+from datetime import datetime, date, time as dtime
+from functools import lru_cache
+from typing import Any, Iterator, Optional
+
+# значения повторяются (сегодня/неделя, 10:00, 14:00) — strptime/strftime кешируем;
+# результаты неизменяемые (str/date/time), ошибки разбора не кешируются
+@lru_cache(maxsize=1024)
+def dstr(d: date) -> str: return d.strftime("%d.%m.%Y")
+@lru_cache(maxsize=1024)
+def tstr(t: Optional[dtime]) -> str: return t.strftime("%H:%M") if t else "—"
+@lru_cache(maxsize=1024)
+def parse_date(s: str) -> date: return datetime.strptime(s, "%d.%m.%Y").date()
+@lru_cache(maxsize=256)
+def parse_time(s: str) -> dtime: return datetime.strptime(s, "%H:%M").time()
+
+_WEEKDAYS_RU = ("Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье")
+def weekday_ru(d: date) -> str: return _WEEKDAYS_RU[d.weekday()]
+
+PR_EMOJI = {"high":"🔴","medium":"🟡","low":"🟢","future":"⏳"}
+def pr_emoji(priority: Optional[str]) -> str: return PR_EMOJI.get(priority or "medium","🟡")
+
+def short_line(t: Any, idx: Optional[int] = None) -> str:
+    assignee = f" → @{t.assignee_id}" if t.assignee_id and t.assignee_id!=t.user_id else ""
+    p = f"{idx}. " if idx is not None else ""
+    return f"{p}{PR_EMOJI.get(t.priority or 'medium','🟡')} {t.category}/{t.subcategory or '—'}: {t.text[:40]}… (до {tstr(t.deadline)}){assignee}"
+
+def _task_line(t: Any) -> str:
+    icon = "✅" if t.status=="выполнено" else "⬜"
+    dl = f"  <i>(до {tstr(t.deadline)})</i>" if t.deadline else ""
+    dg = f"  [делегировано: {t.assignee_id}]" if t.assignee_id and t.assignee_id!=t.user_id else ""
+    return f"    └ {icon} {PR_EMOJI.get(t.priority or 'medium','🟡')} {t.text}{dl}{dg}"
+
+def grouped_lines(tasks: list, header_date: Optional[str] = None) -> Iterator[str]:
+    if header_date: yield f"• {_WEEKDAYS_RU[tasks[0].date.weekday()]} — {header_date}\n"
+    # порядок задаёт SQL (TASK_ORDER): категории/подкатегории идут подряд — заголовок при смене;
+    # как и раньше, для NULL-категории/подкатегории в начале группы заголовок не печатается
+    prev_cat: Any = None; prev_sub: Any = None
+    for t in tasks:
+        cat = t.category; sub = t.subcategory
+        if cat != prev_cat:
+            yield f"📂 <b>{cat or '—'}</b>"
+            prev_cat = cat; prev_sub = None
+        if sub != prev_sub:
+            yield f"  └ <b>{sub or '—'}</b>"
+            prev_sub = sub
+        yield _task_line(t)
+
+def format_grouped(tasks: list, header_date: Optional[str] = None) -> str:
+    if not tasks: return "Задач нет."
+    return "\n".join(grouped_lines(tasks, header_date))
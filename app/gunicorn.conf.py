@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn -c gunicorn.conf.py tasks_bot:app
+
+Один воркер: планировщик (дайджест 08:00, тик правил) и пошаговые мастера
+(RULE_WIZ, SESS в org/ops) живут в памяти процесса — несколько воркеров дали бы
+дубли рассылок и потерю шагов. Конкурентность — потоками (gthread): хендлеры
+блокируются на psycopg2/HTTP, gevent без psycogreen тут ничего не даст.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = 30
+keepalive = 2
+
+def post_worker_init(worker):
+    from tasks_bot import start_scheduler, setup_webhook
+    start_scheduler()
+    setup_webhook()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-TasksBot (polling, PostgreSQL)
+TasksBot (webhook через gunicorn / polling локально, PostgreSQL)
 - Telegram: pyTelegramBotAPI (TeleBot)
 - База: PostgreSQL (SQLAlchemy)
 - Фичи:
@@ -17,22 +17,42 @@ TasksBot (polling, PostgreSQL)
   • Безопасные callback’и (CALLBACK_SECRET), /health, сид направлений
 Env:
   TELEGRAM_TOKEN, DATABASE_URL, TZ (default Europe/Moscow), OPENAI_API_KEY (optional),
-  CALLBACK_SECRET (обязательно для подписи), ADMIN_IDS (опц., кому доступен /health)
+  CALLBACK_SECRET (обязательно для подписи), ADMIN_IDS (опц., кому доступен /health),
+  WEBHOOK_SECRET (опц., проверка заголовка X-Telegram-Bot-Api-Secret-Token),
+  WEBHOOK_BASE (опц., https://домен — setWebhook при старте воркера; без него polling через __main__),
+  RUN_DDL (опц., 1 — create_all/migrate_db/сиды при импорте; по умолчанию схему не трогаем),
+  AI_TIMEOUT (опц., сек на запрос к OpenAI, по умолчанию 3),
+  DIGEST_WORKERS (опц., параллельных отправок дайджеста, по умолчанию 8),
+  BOT_THREADS (опц., потоков обработки апдейтов, по умолчанию 8)
 """
 
-import os, re, json, time, hmac, hashlib, logging, threading
+import os, io, re, csv, time, hmac, hashlib, logging, threading
 from datetime import datetime, timedelta, date, time as dtime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
 from typing import Optional
+from zoneinfo import ZoneInfo
 
-import pytz
-import schedule
+import orjson
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
 
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, abort
 from telebot import TeleBot, types, apihelper
 from sqlalchemy import (
     create_engine, Column, Integer, String, Text, Date, Time, DateTime, Boolean,
-    ForeignKey, func, UniqueConstraint, Index, and_, or_
+    ForeignKey, func, exists, select, insert, update, UniqueConstraint, Index, and_, or_,
+    text as sql_text
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship, selectinload
+
+from formatters import dstr, tstr, parse_date, parse_time, weekday_ru, short_line, format_grouped, grouped_lines, pr_emoji
 
 # --------- ENV / LOG ---------
 API_TOKEN   = os.getenv("TELEGRAM_TOKEN")
@@ -40,29 +60,60 @@ DB_URL      = os.getenv("DATABASE_URL")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TZ_NAME     = os.getenv("TZ", "Europe/Moscow")
 CALLBACK_SECRET = os.getenv("CALLBACK_SECRET", "change-me").encode("utf-8")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_BASE = os.getenv("WEBHOOK_BASE", "")  # https://домен — вебхук ставится при старте gunicorn
+# DDL (create_all, migrate_db, сиды org/ops) при импорте — только по RUN_DDL=1: воркеры
+# вебхука стартуют без запросов к каталогу. Схему накатывает разовый шаг перед запуском:
+# RUN_DDL=1 python -c "import tasks_bot" (сервис migrate в docker-compose)
+RUN_DDL = os.getenv("RUN_DDL") == "1"
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS","").split(",") if x.strip().isdigit()}
 
 if not API_TOKEN or not DB_URL:
     raise RuntimeError("Need TELEGRAM_TOKEN and DATABASE_URL envs")
 
-LOCAL_TZ = pytz.timezone(TZ_NAME)
+LOCAL_TZ = ZoneInfo(TZ_NAME)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 log = logging.getLogger("tasksbot")
 log.info("Boot TasksBot v2025-08-21-rules-ui")
 
 # --------- OpenAI (optional) ---------
 openai_client = None
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "3"))  # сек на запрос; дальше — локальный разбор
 if OPENAI_API_KEY:
     try:
         from openai import OpenAI
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        openai_client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
     except Exception as e:
         log.warning("OpenAI disabled: %s", e)
+# фоновые вызовы OpenAI (разбор «➕ Добавить»), чтобы не блокировать обработчики
+_AI_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ai")
 
 # --------- DB ---------
 Base = declarative_base()
-engine = create_engine(DB_URL, pool_pre_ping=True, future=True)
-SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
+# кеш компиляции побольше (запросы бота однотипные); LIFO держит «горячие» соединения
+# psycopg2: INSERT-пачки одним VALUES (…),(…) (insertmanyvalues), UPDATE/DELETE executemany —
+# через execute_batch; для других драйверов эти ключи create_engine не принимает
+_PG_BATCH = (dict(executemany_mode="values_plus_batch", insertmanyvalues_page_size=1000,
+                  executemany_batch_page_size=500)
+             if make_url(DB_URL).drivername in ("postgresql", "postgresql+psycopg2") else {})
+engine = create_engine(DB_URL, pool_pre_ping=True, future=True,
+                       query_cache_size=1200, pool_size=10, max_overflow=20,
+                       pool_recycle=300, pool_use_lifo=True, echo_pool=False, **_PG_BATCH)
+# expire_on_commit=False: после commit объекты не перечитываются SELECT'ом при следующем обращении
+# (done_text/cb пишут и сразу отвечают из тех же строк); как в org_ext/ops_ext
+SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False,
+                                           expire_on_commit=False))
+
+@contextmanager
+def db():
+    # сессия потока обработчика: вложенные db() (хелперы, next-step) берут ту же из реестра,
+    # remove() — только на внешнем уровне, так identity map живёт весь апдейт
+    outer = not SessionLocal.registry.has()
+    sess = SessionLocal()
+    try:
+        yield sess
+    finally:
+        if outer: SessionLocal.remove()
 
 class User(Base):
     __tablename__ = "users"
@@ -81,6 +132,8 @@ class Direction(Base):
 
 class Supplier(Base):
     __tablename__ = "suppliers"
+    # поиск по имени без учёта регистра (add_supplier_parse): WHERE lower(name)=… идёт по индексу
+    __table_args__ = (Index("idx_suppliers_lower_name", func.lower(sql_text("name"))),)
     id = Column(Integer, primary_key=True)
     name = Column(String(255), unique=True, nullable=False)
     rule = Column(String(255), default="")         # "каждые 2 дня" / "shelf 72h"
@@ -92,23 +145,27 @@ class Supplier(Base):
     auto = Column(Boolean, default=True)
     active = Column(Boolean, default=True)
     direction_id = Column(Integer, ForeignKey("directions.id", ondelete="SET NULL"), nullable=True)
-    direction = relationship("Direction", lazy="joined")
+    direction = relationship("Direction", lazy="select")  # снимок правил поставщиков его не читает
     created_at = Column(DateTime, server_default=func.now())
 
 class Task(Base):
     __tablename__ = "tasks"
     __table_args__ = (
         UniqueConstraint('user_id','date','text','category','subcategory','is_repeating', name='uq_task_day'),
-        Index("idx_tasks_user_date_status", "user_id", "date", "status"),
+        # частичные индексы под два вида запросов: списки/отметка (is_repeating = false) и
+        # шаблоны повторов (is_repeating = true) — меньше и без фильтрации строк в плане;
+        # отдельный ix_tasks_date остаётся для дайджеста по всем пользователям
+        Index("idx_tasks_user_date_notrep", "user_id", "date", postgresql_where=sql_text("is_repeating = false")),
+        Index("idx_tasks_user_repeating", "user_id", postgresql_where=sql_text("is_repeating = true")),
         Index("idx_tasks_user_type", "user_id", "task_type"),
         UniqueConstraint('user_id','date','auto_key', name='uq_tasks_auto_key_date_user'),
     )
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, index=True, nullable=False)
+    user_id = Column(Integer, nullable=False)
     assignee_id = Column(Integer, nullable=True)  # делегировано кому (chat id)
     date = Column(Date, index=True, nullable=False)
-    category = Column(String(120), default="Личное", index=True)
-    subcategory = Column(String(120), default="", index=True)  # ТТ/локация
+    category = Column(String(120), default="Личное")
+    subcategory = Column(String(120), default="")  # ТТ/локация
     text = Column(Text, nullable=False)
     deadline = Column(Time, nullable=True)
     status = Column(String(40), default="")  # "", "выполнено"
@@ -121,8 +178,10 @@ class Task(Base):
     direction_id = Column(Integer, ForeignKey("directions.id", ondelete="SET NULL"), nullable=True)
     supplier_id  = Column(Integer, ForeignKey("suppliers.id", ondelete="SET NULL"), nullable=True)
     auto_key  = Column(String(160), nullable=True)
-    direction = relationship("Direction", lazy="joined")
-    supplier  = relationship("Supplier", lazy="joined")
+    # по требованию: списки задач их не читают, а joined добавлял два LEFT JOIN в каждый запрос Task;
+    # где нужны — .options(selectinload(Task.direction), selectinload(Task.supplier))
+    direction = relationship("Direction", lazy="select")
+    supplier  = relationship("Supplier", lazy="select")
     created_at = Column(DateTime, server_default=func.now())
 
 class Subtask(Base):
@@ -153,11 +212,12 @@ class Rule(Base):
     auto_create = Column(Boolean, default=True)
     title = Column(Text, default="")
     active = Column(Boolean, default=True)
+    # rule_brief показывает имена направления/поставщика; в списках — selectinload, без N+1
+    direction = relationship("Direction", lazy="select")
+    supplier  = relationship("Supplier", lazy="select")
     created_at = Column(DateTime, server_default=func.now())
     __table_args__ = (Index("idx_rules_user_active", "user_id", "active"),)
 
-Base.metadata.create_all(bind=engine)
-
 def migrate_db():
     with engine.begin() as conn:
         conn.exec_driver_sql(
@@ -189,14 +249,28 @@ def migrate_db():
             "ALTER TABLE tasks ADD COLUMN IF NOT EXISTS auto_key VARCHAR(160) NULL;"
         )
         conn.exec_driver_sql(
-            "CREATE INDEX IF NOT EXISTS idx_tasks_user_date_status ON tasks(user_id, date, status);"
+            "CREATE INDEX IF NOT EXISTS idx_tasks_user_date_notrep ON tasks(user_id, date) WHERE is_repeating = false;"
         )
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS idx_tasks_user_repeating ON tasks(user_id) WHERE is_repeating = true;"
+        )
+        # заменён частичным idx_tasks_user_date_notrep
+        conn.exec_driver_sql("DROP INDEX IF EXISTS idx_tasks_user_date_status;")
         conn.exec_driver_sql(
             "CREATE INDEX IF NOT EXISTS idx_tasks_user_type ON tasks(user_id, task_type);"
         )
+        # лишние одиночные индексы: user_id — префикс составного, по category/subcategory
+        # ищем только ILIKE '%…%', btree там не работает, а запись замедляет
+        conn.exec_driver_sql(
+            "DROP INDEX IF EXISTS ix_tasks_user_id, ix_tasks_category, ix_tasks_subcategory;"
+        )
         conn.exec_driver_sql(
             "CREATE INDEX IF NOT EXISTS idx_rules_user_active ON rules(user_id, active);"
         )
+        # не UNIQUE: в старых базах могут быть имена, различающиеся только регистром
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS idx_suppliers_lower_name ON suppliers (lower(name));"
+        )
         # уникальность авто‑ключа
         conn.exec_driver_sql("""
 DO $$
@@ -209,19 +283,33 @@ BEGIN
   END IF;
 END $$;
 """)
-migrate_db()
+
+if RUN_DDL:
+    Base.metadata.create_all(bind=engine)
+    migrate_db()
 
 # --------- BOT ---------
-bot = TeleBot(API_TOKEN, parse_mode="HTML")
+# вебхук только кладёт апдейт в пул потоков TeleBot и сразу отвечает 200; BOT_THREADS —
+# сколько апдейтов обрабатывается параллельно (по умолчанию у telebot всего 2)
+BOT_THREADS = int(os.getenv("BOT_THREADS", "8"))
+bot = TeleBot(API_TOKEN, parse_mode="HTML", threaded=True, num_threads=BOT_THREADS)
+# одна keep-alive сессия на все потоки: TLS-рукопожатие раз на соединение пула, а не на
+# каждый поток; без TTL (по умолчанию telebot пересоздаёт сессию каждые 10 минут)
+_tg_http = requests.Session()
+_tg_http.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=3))
+apihelper.session = _tg_http
+apihelper.SESSION_TIME_TO_LIVE = None
 from org_ext import OrgExt
 from ops_ext import OpsExt
 
 org = OrgExt(bot)   # можно передать свой engine/SessionLocal, если у тебя уже есть
-org.init_db()       # создаст таблицы org_, точки и отчётные шаблоны
+if RUN_DDL:
+    org.init_db()   # создаст таблицы org_, точки и отчётные шаблоны
 org.register()      # зарегистрирует хендлеры /start, /join, отчётность, чек-ин/аут, админ-меню
 
 ops = OpsExt(bot)   # контур перемещений
-ops.init_db()       # создаст таблицы ops_
+if RUN_DDL:
+    ops.init_db()   # создаст таблицы ops_
 ops.register()      # зарегистрирует /ops и всё по перемещениям
 
 PAGE = 8  # повесит хендлеры: приглашения/роли, чек-ин/аут, отчёты, настройки, статистика
@@ -231,30 +319,110 @@ LAST_TICK: Optional[datetime] = None
 def now_local():
     return datetime.now(LOCAL_TZ)
 
-def dstr(d: date): return d.strftime("%d.%m.%Y")
-def tstr(t: dtime|None): return t.strftime("%H:%M") if t else "—"
-def parse_date(s): return datetime.strptime(s, "%d.%m.%Y").date()
-def parse_time(s): return datetime.strptime(s, "%H:%M").time()
+# Разбор свободного текста: шаблоны компилируем один раз
+_RE_TIME = re.compile(r"(\d{1,2}:\d{2})")
+_RE_DATE = re.compile(r"(\d{2}\.\d{2}\.\d{4})")
+_RE_INT  = re.compile(r"\d+")
+_RE_WD_SHORT = re.compile(r"(пн|вт|ср|чт|пт|сб|вс)")
+# Ключевые слова (подстрока, вид, значение); внутри вида порядок = приоритет (раньше — выше).
+# Все ключи в одном regex-альтернативе: текст сканируется один раз вместо каскада `x in tl`
+KEYWORDS = (
+    ("кофейн","cat","Кофейня"), ("к-экспро","cat","Кофейня"), ("вылегжан","cat","Кофейня"), ("табач","cat","Табачка"),
+    ("центр","sub","Центр"), ("полет","sub","Полет"), ("полёт","sub","Полет"), ("климов","sub","Климово"),
+    ("к-экспро","sup","К-Экспро"), ("k-exp","sup","К-Экспро"), ("к экспро","sup","К-Экспро"), ("вылегжан","sup","ИП Вылегжанина"),
+    ("сегодня","day",0), ("завтра","day",1),   # смещение даты в днях
+)
+_KW_BY_TOKEN = {}
+for _i, (_tok, _kind, _val) in enumerate(KEYWORDS):
+    _KW_BY_TOKEN.setdefault(_tok, []).append((_i, _kind, _val))
+# re.I: исходный текст не приводим к нижнему регистру целиком
+_KW_RE = re.compile("|".join(map(re.escape, sorted(_KW_BY_TOKEN, key=len, reverse=True))), re.I)
+
+def scan_keywords(tl:str)->dict:
+    """Один проход по тексту (регистр не важен): {вид: [значения по приоритету]}."""
+    out = {}
+    for _, kind, val in sorted({e for m in _KW_RE.finditer(tl) for e in _KW_BY_TOKEN[m.group().lower()]}):
+        vals = out.setdefault(kind, [])
+        if val not in vals: vals.append(val)
+    return out
 
-def weekday_ru(d: date):
-    names = ["Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье"]
-    return names[d.weekday()]
+# Поставщики — отдельной альтернативой с группой на каждого (s0, s1… в порядке таблицы):
+# detect_supplier вызывается на каждое «выполнено» и не сканирует категории/подкатегории
+_SUP_NAMES = list(dict.fromkeys(v for _, k, v in KEYWORDS if k=="sup"))
+_SUP_RE = re.compile("|".join(
+    f"(?P<s{i}>" + "|".join(re.escape(t) for t, k, v in
+                            sorted(KEYWORDS, key=lambda e: len(e[0]), reverse=True) if k=="sup" and v==name) + ")"
+    for i, name in enumerate(_SUP_NAMES)), re.I)
+
+def detect_supplier(txt:str)->str:
+    """Поставщик по ключевым словам в тексте (регистр не важен)."""
+    # как раньше: при нескольких — последний в таблице
+    hit = max((int(m.lastgroup[1:]) for m in _SUP_RE.finditer(txt)), default=None)
+    return _SUP_NAMES[hit] if hit is not None else ""
+
+# ключ BLAKE2s не длиннее 32 байт — длинный секрет сжимаем
+_CB_KEY = CALLBACK_SECRET if len(CALLBACK_SECRET) <= 32 else hashlib.blake2s(CALLBACK_SECRET).digest()
+
+# состояние с уже обработанным блоком ключа; .copy() дешевле, чем заново ключевать на каждую кнопку
+_CB_HASHER = hashlib.blake2s(key=_CB_KEY, digest_size=3)
+
+def _cb_sign(raw:bytes)->str:
+    h = _CB_HASHER.copy(); h.update(raw)
+    return h.hexdigest()
+
+# Схема callback_data: действие -> позиционные поля. Значения — короткие строки без "|",
+# на выходе "sig|action|v1|v2": без JSON и заметно короче лимита Telegram в 64 байта
+CB_FIELDS = {
+    "open":("id",), "done":("id",), "del":("id",), "setdl":("id",), "rem":("id",), "sub":("id",), "dlg":("id",),
+    "mv":("id","to"), "page":("p","pa"),
+    "r_add":(), "r_back":(), "r_cancel":(), "r_wd_done":(),
+    "r_dir":("id",), "r_sup":("id",), "r_type":("v",), "r_per":("v",), "r_wd":("d",),
+    "r_time_set":("v",), "r_before":("v",), "r_auto_set":("v",),
+    "r_info":("id",), "r_edit":("id",), "r_time":("id",), "r_auto":("id",), "r_active":("id",), "r_del":("id",),
+    "r_page":("p",),
+}
+# короткий код действия на проводе (callback_data ≤ 64 байт); коды не переиспользовать —
+# старые кнопки в чатах продолжают подписываться и разбираться
+CB_CODES = {
+    "open":"o", "done":"d", "del":"x", "setdl":"l", "rem":"n", "sub":"s", "dlg":"g", "mv":"m", "page":"p",
+    "r_add":"ra", "r_back":"rb", "r_cancel":"rc", "r_wd_done":"rw",
+    "r_dir":"rd", "r_sup":"rs", "r_type":"rt", "r_per":"rp", "r_wd":"rx",
+    "r_time_set":"rh", "r_before":"rf", "r_auto_set":"ru",
+    "r_info":"ri", "r_edit":"re", "r_time":"rm", "r_auto":"rq", "r_active":"rv", "r_del":"rz",
+    "r_page":"rg",
+}
+_CB_ACTION = {v: k for k, v in CB_CODES.items()}
 
-def _cb_sign(s:str)->str:
-    return hashlib.sha1(CALLBACK_SECRET + s.encode("utf-8")).hexdigest()[:6]
+@lru_cache(maxsize=1024)
+def _mk_cb_cached(action:str, values:tuple)->str:
+    s = "|".join((CB_CODES[action], *values))
+    return f"{_cb_sign(s.encode('utf-8'))}|{s}"
 
 def mk_cb(action, **kwargs):
-    payload = {"v":1, "a": action, **kwargs}
-    s = json.dumps(payload, ensure_ascii=False, separators=(",",":"))
-    sig = _cb_sign(s)
-    return f"{sig}|{s}"
+    # одинаковые кнопки меню/пагинации строятся постоянно — подпись кешируем
+    return _mk_cb_cached(action, tuple(str(kwargs.get(f, "")) for f in CB_FIELDS[action]))
 
+_NOOP = "noop"  # центральная кнопка пагинации, без подписи
+
+@lru_cache(maxsize=2048)
 def parse_cb(data):
+    # одна и та же кнопка проверяется в фильтрах хендлеров и в самом хендлере;
+    # результат общий из кеша — только читать, не менять
+    # короче «sig|a» или без разделителя (noop и пр.) — не подписано, HMAC не считаем
+    if not data or len(data) < 8 or "|" not in data:
+        return None
     try:
         sig, s = data.split("|", 1)
-        if _cb_sign(s) != sig:
+        if not hmac.compare_digest(_cb_sign(s.encode("utf-8")), sig):
+            return None
+        code, *vals = s.split("|")
+        # только короткие коды; кнопки старого формата (JSON + SHA1) подпись не проходят —
+        # после выкладки уже отправленные inline-кнопки не работают, меню открывают заново
+        a = _CB_ACTION[code]
+        fields = CB_FIELDS[a]
+        if len(vals) != len(fields):
             return None
-        return json.loads(s)
+        return {"a": a, **{f: v for f, v in zip(fields, vals) if v}}
     except Exception:
         return None
 
@@ -265,20 +433,52 @@ def ensure_user(sess, uid, name="", tz=None):
         sess.add(u); sess.commit()
     return u
 
-# безопасная отправка (бэкофф)
+def own_task(sess, tid:int, uid:int)->Optional[Task]:
+    # PK-get сначала смотрит identity map; владельца проверяем в Python
+    t = sess.get(Task, tid)
+    return t if t is not None and t.user_id==uid else None
+
+# безопасная отправка (бэкофф, retry_after на 429)
+# глобальный лимит Telegram ~30 сообщений/с: каждый вызов занимает следующий слот
+SEND_RATE = 30
+_send_next = 0.0
+_send_lock = threading.Lock()
+
+def _send_slot():
+    global _send_next
+    with _send_lock:
+        now = time.monotonic()
+        at = max(now, _send_next)
+        _send_next = at + 1.0 / SEND_RATE
+    if at > now: time.sleep(at - now)
+
+TG_MAX_TEXT = 4096
+
+def cut_lines(text, limit=TG_MAX_TEXT):
+    """Обрезка HTML-текста по границе строки: теги (<b>, <i>) у нас не переходят через \n."""
+    if len(text) <= limit: return text
+    cut = text.rfind("\n", 0, limit - 2)
+    return (text[:cut] if cut > 0 else text[:limit - 2]) + "\n…"
+
 def send_safe(text, chat_id, **kwargs):
+    # обрезаем сразу: длинный текст не уходит заведомо отклонённым запросом
+    text = cut_lines(text)
     delay = 0.5
     for _ in range(6):
+        _send_slot()
         try:
             return bot.send_message(chat_id, text, **kwargs)
         except apihelper.ApiTelegramException as e:
-            sc = getattr(e.result, "status_code", None)
-            if sc in (429, 500, 502, 503, 504):
-                time.sleep(delay); delay *= 2; continue
+            if e.error_code == 429:
+                # Telegram сам говорит, сколько ждать — спим ровно столько, без экспоненты
+                ra = ((e.result_json or {}).get("parameters") or {}).get("retry_after")
+                time.sleep((ra + 0.1) if ra else delay); delay *= 2; continue
+            if e.error_code < 500: raise  # прочие 4xx повтором не исправить
             time.sleep(delay); delay *= 2
         except Exception:
-            time.sleep(delay); delay *= 2
-    return bot.send_message(chat_id, text[:4000], **kwargs)
+            time.sleep(delay); delay *= 2  # сеть/таймаут
+    _send_slot()
+    return bot.send_message(chat_id, cut_lines(text, 4000), **kwargs)
 
 # --------- Suppliers rules / plan (твоя логика оставлена) ---------
 BASE_SUP_RULES = {
@@ -287,185 +487,263 @@ BASE_SUP_RULES = {
 }
 def norm_sup(name:str): return (name or "").strip().lower()
 
+# Поставщиков меняют редко: всю таблицу держим в памяти снимком {norm_sup(name): rule}
+# (dict, не ORM-объекты), перечитываем раз в SUP_TTL_SEC одним запросом
+SUP_TTL_SEC = 60
+_SUP_SNAP = (0.0, {})   # (monotonic ts, rules)
+_SUP_LOCK = threading.Lock()
+
+def sup_cache_invalidate():
+    # правка любого поставщика — следующий load_rule перечитает снимок
+    global _SUP_SNAP
+    with _SUP_LOCK:
+        _SUP_SNAP = (0.0, _SUP_SNAP[1])
+
 def load_rule(sess, supplier_name:str):
-    s = sess.query(Supplier).filter(func.lower(Supplier.name)==norm_sup(supplier_name)).first()
-    if s and s.active:
+    global _SUP_SNAP
+    ts, rules = _SUP_SNAP
+    if time.monotonic() - ts >= SUP_TTL_SEC:
+        with _SUP_LOCK:
+            ts, rules = _SUP_SNAP
+            if time.monotonic() - ts >= SUP_TTL_SEC:
+                rules = _load_rules_db(sess)
+                _SUP_SNAP = (time.monotonic(), rules)
+    key = norm_sup(supplier_name)
+    return rules[key] if key in rules else BASE_SUP_RULES.get(key)
+
+def _load_rules_db(sess):
+    out = {}
+    for s in sess.scalars(select(Supplier).where(Supplier.active==True)):
         rl = (s.rule or "").lower()
         if "каждые" in rl:
-            m = re.findall(r"\d+", rl); n = int(m[0]) if m else 2
-            return {"kind":"cycle_every_n_days","n_days":n,"delivery_offset":s.delivery_offset_days or 1,
-                    "deadline":s.order_deadline or "14:00","emoji":s.emoji or "📦"}
-        if any(x in rl for x in ["shelf","72","хранен"]):
-            return {"kind":"delivery_shelf_then_order","delivery_offset":s.delivery_offset_days or 1,
-                    "shelf_days":s.shelf_days or 3,"deadline":s.order_deadline or "14:00","emoji":s.emoji or "🥘"}
-    return BASE_SUP_RULES.get(norm_sup(supplier_name))
-
-def plan_next(sess, user_id:int, supplier:str, category:str, subcategory:str):
+            m = _RE_INT.findall(rl); n = int(m[0]) if m else 2
+            out[norm_sup(s.name)] = {"kind":"cycle_every_n_days","n_days":n,"delivery_offset":s.delivery_offset_days or 1,
+                                     "deadline":s.order_deadline or "14:00","emoji":s.emoji or "📦"}
+        elif any(x in rl for x in ["shelf","72","хранен"]):
+            out[norm_sup(s.name)] = {"kind":"delivery_shelf_then_order","delivery_offset":s.delivery_offset_days or 1,
+                                     "shelf_days":s.shelf_days or 3,"deadline":s.order_deadline or "14:00","emoji":s.emoji or "🥘"}
+    return out
+
+def plan_next(sess, user_id:int, supplier:str, category:str, subcategory:str, today:Optional[date]=None):
     rule = load_rule(sess, supplier)
     if not rule: return []
-    today = now_local().date()
-    out = []
+    today = today or now_local().date()  # вызывающий хендлер передаёт уже посчитанную дату
     if rule["kind"]=="cycle_every_n_days":
         delivery = today + timedelta(days=rule["delivery_offset"])
         next_order = today + timedelta(days=rule["n_days"])
-        sess.merge(Task(user_id=user_id, date=delivery, category=category, subcategory=subcategory,
-                        text=f"{rule['emoji']} Принять поставку {supplier} ({subcategory or '—'})",
-                        deadline=parse_time("10:00"), task_type="purchase", priority="high"))
-        sess.merge(Task(user_id=user_id, date=next_order, category=category, subcategory=subcategory,
-                        text=f"{rule['emoji']} Заказать {supplier} ({subcategory or '—'})",
-                        deadline=parse_time(rule["deadline"]), task_type="purchase", priority="high"))
-        sess.commit()
-        out = [("delivery", delivery), ("order", next_order)]
+        accept_at = "10:00"
     else:
         delivery = today + timedelta(days=rule["delivery_offset"])
         next_order = delivery + timedelta(days=max(1, (rule.get("shelf_days",3)-1)))
-        sess.merge(Task(user_id=user_id, date=delivery, category=category, subcategory=subcategory,
-                        text=f"{rule['emoji']} Принять поставку {supplier} ({subcategory or '—'})",
-                        deadline=parse_time("11:00"), task_type="purchase", priority="high"))
-        sess.merge(Task(user_id=user_id, date=next_order, category=category, subcategory=subcategory,
-                        text=f"{rule['emoji']} Заказать {supplier} ({subcategory or '—'})",
-                        deadline=parse_time(rule["deadline"]), task_type="purchase", priority="high"))
-        sess.commit()
-        out = [("delivery", delivery), ("order", next_order)]
-    return out
+        accept_at = "11:00"
+    base = dict(user_id=user_id, category=category, subcategory=subcategory, task_type="purchase", priority="high")
+    rows = [
+        dict(base, date=delivery, text=f"{rule['emoji']} Принять поставку {supplier} ({subcategory or '—'})",
+             deadline=parse_time(accept_at)),
+        dict(base, date=next_order, text=f"{rule['emoji']} Заказать {supplier} ({subcategory or '—'})",
+             deadline=parse_time(rule["deadline"])),
+    ]
+    for r in rows:
+        r["auto_key"] = make_auto_key(user_id, r["date"], f"{category}|{r['text']}", None, None, "purchase")
+        # задачи, созданные до auto_key (auto_key IS NULL), получают ключ здесь: иначе вставка
+        # ниже упирается в uq_task_day, а не в uq_tasks_auto_key_date_user, и падает IntegrityError
+        # (одну строку и только если ключ ещё не занят — сам UPDATE не должен нарушить уникальность)
+        legacy = (select(func.min(Task.id))
+                  .where(Task.user_id==user_id, Task.date==r["date"], Task.text==r["text"],
+                         Task.category==category, Task.is_repeating==False, Task.auto_key.is_(None),
+                         ~exists().where(Task.user_id==user_id, Task.date==r["date"],
+                                         Task.auto_key==r["auto_key"]))
+                  .scalar_subquery())
+        sess.execute(update(Task).where(Task.id==legacy).values(auto_key=r["auto_key"])
+                     .execution_options(synchronize_session=False))
+    # обе задачи одним UPSERT: повторная отметка «сделал» в тот же день не плодит дубли,
+    # а обновляет срок/приоритет по текущему правилу поставщика
+    stmt = pg_insert(Task).values(rows)
+    sess.execute(stmt.on_conflict_do_update(
+        constraint="uq_tasks_auto_key_date_user",
+        set_={"text": stmt.excluded.text, "deadline": stmt.excluded.deadline, "priority": stmt.excluded.priority}))
+    sess.commit()
+    return [("delivery", delivery), ("order", next_order)]
 
 # --------- Repeats (твоя логика оставлена) ---------
-def rule_hits_date(rule_text:str, created_at:datetime, target:date, template_deadline: dtime|None) -> dtime|None:
-    if not rule_text: return None
+_WD_FULL = {"пн":0,"вт":1,"ср":2,"чт":3,"пт":4,"сб":5,"вс":6,
+            "понедельник":0,"вторник":1,"среда":2,"четверг":3,"пятница":4,"суббота":5,"воскресенье":6}
+_WD_SHORT = {"пн":0,"вт":1,"ср":2,"чт":3,"пт":4,"сб":5,"вс":6}
+
+# правило шаблона разбирается один раз: expand_repeats зовёт rule_hits_date на каждый шаблон × дату
+@lru_cache(maxsize=512)
+def _parse_rule(rule_text:str) -> tuple:
     rl = rule_text.strip().lower()
     if rl.startswith("каждые"):
-        m = re.findall(r"\d+", rl); n = int(m[0]) if m else 1
-        base = created_at.date() if created_at else date(2025,1,1)
-        delta = (target - base).days
-        return template_deadline if (delta >= 0 and delta % n == 0) else None
+        m = _RE_INT.findall(rl)
+        return ("every_n", int(m[0]) if m else 1)
     if rl.startswith("каждый"):
-        days = {"пн":0,"вт":1,"ср":2,"чт":3,"пт":4,"сб":5,"вс":6,
-                "понедельник":0,"вторник":1,"среда":2,"четверг":3,"пятница":4,"суббота":5,"воскресенье":6}
         wd = None
-        for k,v in days.items():
+        for k,v in _WD_FULL.items():
             if f" {k}" in f" {rl}": wd=v; break
-        if wd is None or target.weekday()!=wd: return None
-        tm = re.search(r"(\d{1,2}:\d{2})", rl)
-        return parse_time(tm.group(1)) if tm else template_deadline
+        tm = _RE_TIME.search(rl)
+        return ("weekday", wd, parse_time(tm.group(1)) if tm else None)
     if rl.startswith("по "):
-        m = re.findall(r"(пн|вт|ср|чт|пт|сб|вс)", rl)
-        mapd = {"пн":0,"вт":1,"ср":2,"чт":3,"пт":4,"сб":5,"вс":6}
-        wds = {mapd[x] for x in m} if m else set()
-        return template_deadline if target.weekday() in wds else None
+        return ("weekdays", frozenset(_WD_SHORT[x] for x in _RE_WD_SHORT.findall(rl)))
+    return ("none",)
+
+def rule_hits_date(rule_text:str, created_at:datetime, target:date, template_deadline: dtime|None) -> dtime|None:
+    if not rule_text: return None
+    rule = _parse_rule(rule_text)
+    kind = rule[0]
+    if kind == "every_n":
+        base = created_at.date() if created_at else date(2025,1,1)
+        delta = (target - base).days
+        return template_deadline if (delta >= 0 and delta % rule[1] == 0) else None
+    if kind == "weekday":
+        if rule[1] is None or target.weekday()!=rule[1]: return None
+        return rule[2] or template_deadline
+    if kind == "weekdays":
+        return template_deadline if target.weekday() in rule[1] else None
     return None
 
 def expand_repeats_for_date(sess, uid:int, target:date):
+    expand_repeats_for_range(sess, uid, target, 1)
+
+def expand_repeats_for_range(sess, uid:int, start:date, days:int):
+    # шаблоны читаем один раз на весь диапазон (неделя — 1 SELECT и 1 INSERT вместо 7+7)
     templates = sess.query(Task).filter(Task.user_id==uid, Task.is_repeating==True).all()
-    for t in templates:
-        hit_deadline = rule_hits_date(t.repeat_rule or "", t.created_at, target, t.deadline)
-        if not hit_deadline: continue
-        exists = (sess.query(Task)
-                  .filter(Task.user_id==uid, Task.date==target, Task.is_repeating==False,
-                          Task.text==t.text, Task.category==t.category, Task.subcategory==t.subcategory)
-                  .first())
-        if exists: continue
-        sess.add(Task(user_id=uid, date=target, category=t.category, subcategory=t.subcategory,
-                      text=t.text, deadline=hit_deadline, status="", repeat_rule="",
-                      source="repeat-instance", is_repeating=False))
-    sess.commit()
+    rows = []
+    for target in (start + timedelta(days=i) for i in range(days)):
+        for t in templates:
+            hit_deadline = rule_hits_date(t.repeat_rule or "", t.created_at, target, t.deadline)
+            if not hit_deadline: continue
+            # subcategory NULL → "" (дефолт колонки): NULL в уникальном ключе не конфликтует
+            rows.append(dict(user_id=uid, date=target, category=t.category, subcategory=t.subcategory or "",
+                             text=t.text, deadline=hit_deadline, status="", repeat_rule="",
+                             source="repeat-instance", is_repeating=False))
+    if rows:
+        # дубли отсекает uq_task_day на стороне PostgreSQL — без проверки exists() на каждый шаблон
+        sess.execute(pg_insert(Task).values(rows).on_conflict_do_nothing(constraint="uq_task_day"))
+        sess.commit()
 
 # --------- Formatting / keyboards ---------
-def short_line(t: Task, idx=None):
-    assignee = f" → @{t.assignee_id}" if t.assignee_id and t.assignee_id!=t.user_id else ""
-    p = f"{idx}. " if idx is not None else ""
-    pr_emoji = {"high":"🔴","medium":"🟡","low":"🟢","future":"⏳"}.get(t.priority or "medium","🟡")
-    return f"{p}{pr_emoji} {t.category}/{t.subcategory or '—'}: {t.text[:40]}… (до {tstr(t.deadline)}){assignee}"
-
-def format_grouped(tasks, header_date=None):
-    if not tasks: return "Задач нет."
-    out = []
-    if header_date:
-        out.append(f"• {weekday_ru(tasks[0].date)} — {header_date}\n")
-    cur_cat = cur_sub = None
-    for t in sorted(tasks, key=lambda x: (x.category or "", x.subcategory or "", x.deadline or dtime.min, x.text)):
-        icon = "✅" if t.status=="выполнено" else "⬜"
-        if t.category != cur_cat:
-            out.append(f"📂 <b>{t.category or '—'}</b>"); cur_cat = t.category; cur_sub = None
-        if t.subcategory != cur_sub:
-            out.append(f"  └ <b>{t.subcategory or '—'}</b>"); cur_sub = t.subcategory
-        pr_emoji = {"high":"🔴","medium":"🟡","low":"🟢","future":"⏳"}.get(t.priority or "medium","🟡")
-        line = f"    └ {icon} {pr_emoji} {t.text}"
-        if t.deadline: line += f"  <i>(до {tstr(t.deadline)})</i>"
-        if t.assignee_id and t.assignee_id!=t.user_id: line += f"  [делегировано: {t.assignee_id}]"
-        out.append(line)
-    return "\n".join(out)
-
 def page_kb(items, page, total, action="open"):
     kb = types.InlineKeyboardMarkup()
     for label, tid in items:
         kb.add(types.InlineKeyboardButton(label, callback_data=mk_cb(action, id=tid)))
+    kb.row(*_page_nav(page, total, action))
+    return kb
+
+@lru_cache(maxsize=256)
+def _page_nav(page, total, action):
+    # ряд «⬅️ n/N ➡️» зависит только от (page, total, action) — кнопки только читаются при to_json
     nav = []
     if page>1: nav.append(types.InlineKeyboardButton("⬅️", callback_data=mk_cb("page", p=page-1, pa=action)))
-    nav.append(types.InlineKeyboardButton(f"{page}/{total}", callback_data="noop"))
+    nav.append(types.InlineKeyboardButton(f"{page}/{total}", callback_data=_NOOP))
     if page<total: nav.append(types.InlineKeyboardButton("➡️", callback_data=mk_cb("page", p=page+1, pa=action)))
-    if nav: kb.row(*nav)
-    return kb
+    return tuple(nav)
 
-def tasks_for_date(sess, uid:int, d:date):
-    return (sess.query(Task)
-            .filter(Task.user_id==uid, Task.date==d, Task.is_repeating==False)
-            .order_by(Task.category.asc(), Task.subcategory.asc(), Task.deadline.asc().nulls_last())
-            ).all()
+@lru_cache(maxsize=1024)
+def open_kb(tid):
+    # клавиатура карточки зависит только от id задачи — собираем и сериализуем один раз на id
+    kb = types.InlineKeyboardMarkup()
+    kb.row(types.InlineKeyboardButton("✅ Выполнить", callback_data=mk_cb("done", id=tid)),
+           types.InlineKeyboardButton("🗑 Удалить", callback_data=mk_cb("del", id=tid)))
+    kb.row(types.InlineKeyboardButton("✏️ Дедлайн", callback_data=mk_cb("setdl", id=tid)),
+           types.InlineKeyboardButton("⏰ Напоминание", callback_data=mk_cb("rem", id=tid)))
+    # быстрый перенос (минимум)
+    kb.row(types.InlineKeyboardButton("📤 Сегодня", callback_data=mk_cb("mv", id=tid, to="today")),
+           types.InlineKeyboardButton("📤 Завтра",  callback_data=mk_cb("mv", id=tid, to="tomorrow")),
+           types.InlineKeyboardButton("📤 +1д",     callback_data=mk_cb("mv", id=tid, to="+1")))
+    return kb.to_json()
+
+# Канонический порядок списков: по нему format_grouped группирует без пересортировки.
+# Повторяет прежнюю Python-сортировку (category or "", subcategory or "", deadline or 00:00, text):
+# NULL как пустая строка/начало дня, COLLATE "C" — сравнение по кодам символов, как у str
+TASK_ORDER = (func.coalesce(Task.category, "").collate("C").asc(),
+              func.coalesce(Task.subcategory, "").collate("C").asc(),
+              Task.deadline.asc().nulls_first(), Task.text.collate("C").asc())
+def task_order_key(t):
+    # TASK_ORDER на стороне Python
+    return (t.category or "", t.subcategory or "", t.deadline or dtime.min, t.text or "")
+
+# Колонки, которые читают format_grouped/short_line: для списков «только показать» берём
+# лёгкие Row (атрибутный доступ как у Task) без ORM-объектов и identity map
+TASK_VIEW_COLS = (Task.id, Task.user_id, Task.date, Task.category, Task.subcategory, Task.text,
+                  Task.deadline, Task.status, Task.priority, Task.assignee_id)
+
+# Списочные представления только читают — отдаём Core Row (TASK_VIEW_COLS), не Task:
+# без InstanceState/identity map на строку. Менять задачи — через own_task/update()
+def tasks_for_date(sess, uid:int, d:date, *extra):
+    return sess.execute(select(*TASK_VIEW_COLS)
+                        .where(Task.user_id==uid, Task.date==d, Task.is_repeating==False, *extra)
+                        .order_by(*TASK_ORDER)).all()
 
 def tasks_for_week(sess, uid:int, base:date):
     days = [base + timedelta(days=i) for i in range(7)]
-    return (sess.query(Task)
-            .filter(Task.user_id==uid, Task.date.in_(days), Task.is_repeating==False)
-            .order_by(Task.date.asc(), Task.category.asc(), Task.subcategory.asc(), Task.deadline.asc().nulls_last())
-            ).all()
-
-def main_menu():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("📅 Сегодня","📆 Неделя")
-    kb.row("➕ Добавить","✅ Я сделал…","🧠 Ассистент")
-    kb.row("🚚 Поставки","🔎 Найти")
-    kb.row("⚙️ Правила","👤 Профиль","🧩 Зависимости","🤝 Делегирование")
-    return kb
+    return sess.execute(select(*TASK_VIEW_COLS)
+                        .where(Task.user_id==uid, Task.date.in_(days), Task.is_repeating==False)
+                        .order_by(Task.date.asc(), *TASK_ORDER)).all()
+
+# Главное меню одинаково для всех — собираем и сериализуем один раз: reply_markup-строку
+# telebot отправляет как есть, без to_json() на каждое сообщение
+_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+_kb.row("📅 Сегодня","📆 Неделя")
+_kb.row("➕ Добавить","✅ Я сделал…","🧠 Ассистент")
+_kb.row("🚚 Поставки","🔎 Найти")
+_kb.row("⚙️ Правила","👤 Профиль","🧩 Зависимости","🤝 Делегирование")
+MAIN_MENU = _kb.to_json()
+# подменю поставок и профиля тоже статичны
+_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+_kb.row("📦 Заказы сегодня","🆕 Добавить поставщика")
+_kb.row("⬅️ Назад")
+SUPPLIES_MENU = _kb.to_json()
+_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+_kb.row("🕒 TZ", "📨 Дайджест 08:00")
+_kb.row("⬅️ Назад")
+PROFILE_MENU = _kb.to_json()
+del _kb
 
 # --------- NLP add (твоя логика) ---------
+@lru_cache(maxsize=512)
+def _ai_items(text:str, today_s:str)->tuple:
+    # одинаковые формулировки («сделать заказы к-экспро центр») не гоняем в OpenAI повторно;
+    # дата в ключе: «сегодня/завтра» на следующий день разбираются заново.
+    # исключение (таймаут/ошибка) не кешируется
+    sys = ("Ты парсер задач. Верни только JSON-объект {items:[...]}, элементы: "
+           "{date:'ДД.ММ.ГГГГ'|'', time:'ЧЧ:ММ'|'', category, subcategory, task, repeat:'', supplier:''}. "
+           f"Сегодня {today_s}.")
+    # JSON mode: ответ всегда валидный объект, без ```-обёрток
+    resp = openai_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role":"system","content":sys},{"role":"user","content":text}],
+        temperature=0.2,
+        response_format={"type":"json_object"},
+        timeout=AI_TIMEOUT
+    )
+    data = orjson.loads(resp.choices[0].message.content)["items"]
+    if isinstance(data, dict): data = [data]
+    return tuple({
+        "date": it.get("date") or "",
+        "time": it.get("time") or "",
+        "category": it.get("category") or "Личное",
+        "subcategory": it.get("subcategory") or "",
+        "task": it.get("task") or "",
+        "repeat": it.get("repeat") or "",
+        "supplier": it.get("supplier") or "",
+    } for it in data)
+
 def ai_parse_items(text, uid):
     if openai_client:
         try:
-            sys = ("Ты парсер задач. Верни только JSON-массив объектов: "
-                   "{date:'ДД.ММ.ГГГГ'|'', time:'ЧЧ:ММ'|'', category, subcategory, task, repeat:'', supplier:''}.")
-            resp = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role":"system","content":sys},{"role":"user","content":text}],
-                temperature=0.2
-            )
-            raw = resp.choices[0].message.content.strip()
-            data = json.loads(raw)
-            if isinstance(data, dict): data = [data]
-            out = []
-            for it in data:
-                out.append({
-                    "date": it.get("date") or "",
-                    "time": it.get("time") or "",
-                    "category": it.get("category") or "Личное",
-                    "subcategory": it.get("subcategory") or "",
-                    "task": it.get("task") or "",
-                    "repeat": it.get("repeat") or "",
-                    "supplier": it.get("supplier") or "",
-                    "user_id": uid
-                })
-            return out
+            return [dict(it, user_id=uid) for it in _ai_items(text, dstr(now_local().date()))]
         except Exception as e:
             log.warning("AI parse fail: %s", e)
-    tl = text.lower()
-    cat = "Кофейня" if any(x in tl for x in ["кофейн","к-экспро","вылегжан"]) else ("Табачка" if "табач" in tl else "Личное")
-    sub = "Центр" if "центр" in tl else ("Полет" if ("полет" in tl or "полёт" in tl) else ("Климово" if "климов" in tl else ""))
-    tm = re.search(r"(\d{1,2}:\d{2})", text)
+    kw = scan_keywords(text)
+    cat = kw["cat"][0] if "cat" in kw else "Личное"
+    sub = kw["sub"][0] if "sub" in kw else ""
+    tm = _RE_TIME.search(text)
     time_s = tm.group(1) if tm else ""
-    if "сегодня" in tl: ds = dstr(now_local().date())
-    elif "завтра" in tl: ds = dstr(now_local().date()+timedelta(days=1))
+    if "day" in kw: ds = dstr(now_local().date()+timedelta(days=kw["day"][0]))
     else:
-        m = re.search(r"(\d{2}\.\d{2}\.\d{4})", text); ds = m.group(1) if m else ""
-    supplier = "К-Экспро" if ("к-экспро" in tl or "k-exp" in tl or "к экспро" in tl) else ("ИП Вылегжанина" if "вылегжан" in tl else "")
+        m = _RE_DATE.search(text); ds = m.group(1) if m else ""
+    supplier = kw["sup"][0] if "sup" in kw else ""
     return [{
         "date": ds, "time": time_s, "category": cat, "subcategory": sub,
         "task": text.strip(), "repeat":"", "supplier": supplier, "user_id": uid
@@ -474,55 +752,47 @@ def ai_parse_items(text, uid):
 # --------- Handlers ---------
 @bot.message_handler(commands=["start"])
 def start(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         ensure_user(sess, m.chat.id, m.from_user.full_name if m.from_user else "", tz=TZ_NAME)
         # сид направлений (если пусто)
         if sess.query(Direction).count() == 0:
             for name,emoji,sort in [("Кофейня","☕",10),("WB","📦",20),("Табачка","🚬",30),("Личное","🏠",40)]:
                 sess.add(Direction(name=name, emoji=emoji, sort_order=sort))
             sess.commit()
-    finally:
-        sess.close()
-    bot.send_message(m.chat.id, "Привет! Я твой ассистент по задачам.", reply_markup=main_menu())
+    bot.send_message(m.chat.id, "Привет! Я твой ассистент по задачам.", reply_markup=MAIN_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "📅 Сегодня")
 def today(m):
-    sess = SessionLocal()
-    try:
-        uid = m.chat.id
-        expand_repeats_for_date(sess, uid, now_local().date())
-        rows = tasks_for_date(sess, uid, now_local().date())
-        if not rows:
-            bot.send_message(uid, f"📅 Задачи на {dstr(now_local().date())}\n\nЗадач нет.", reply_markup=main_menu()); return
-        items = [(short_line(t, i), t.id) for i,t in enumerate(rows, start=1)]
-        total = (len(items)+PAGE-1)//PAGE or 1
-        kb = page_kb(items[:PAGE], 1, total, "open")
-        header = f"📅 Задачи на {dstr(now_local().date())}\n\n" + format_grouped(rows, header_date=dstr(now_local().date())) + "\n\nОткрой карточку:"
-        bot.send_message(uid, header, reply_markup=main_menu())
-        bot.send_message(uid, "Навигация по задачам:", reply_markup=kb)
-    finally:
-        sess.close()
+    uid = m.chat.id
+    _today = now_local().date(); _today_s = dstr(_today)
+    # в сессии только БД; сообщения шлём после выхода — соединение уже вернулось в пул
+    with db() as sess:
+        expand_repeats_for_date(sess, uid, _today)
+        rows = tasks_for_date(sess, uid, _today)
+    if not rows:
+        bot.send_message(uid, f"📅 Задачи на {_today_s}\n\nЗадач нет.", reply_markup=MAIN_MENU); return
+    items = [(short_line(t, i), t.id) for i,t in enumerate(rows, start=1)]
+    total = (len(items)+PAGE-1)//PAGE or 1
+    kb = page_kb(items[:PAGE], 1, total, "open")
+    header = f"📅 Задачи на {_today_s}\n\n" + format_grouped(rows, header_date=_today_s) + "\n\nОткрой карточку:"
+    bot.send_message(uid, header, reply_markup=MAIN_MENU)
+    bot.send_message(uid, "Навигация по задачам:", reply_markup=kb)
 
 @bot.message_handler(func=lambda msg: msg.text == "📆 Неделя")
 def week(m):
-    sess = SessionLocal()
-    try:
-        uid = m.chat.id
-        base = now_local().date()
-        for i in range(7):
-            expand_repeats_for_date(sess, uid, base+timedelta(days=i))
+    uid = m.chat.id
+    base = now_local().date()
+    with db() as sess:
+        expand_repeats_for_range(sess, uid, base, 7)
         rows = tasks_for_week(sess, uid, base)
-        if not rows:
-            bot.send_message(uid, "На неделю задач нет.", reply_markup=main_menu()); return
-        by = {}
-        for t in rows: by.setdefault(dstr(t.date), []).append(t)
-        parts = []
-        for ds in sorted(by.keys(), key=lambda s: parse_date(s)):
-            parts.append(format_grouped(by[ds], header_date=ds)); parts.append("")
-        bot.send_message(uid, "\n".join(parts), reply_markup=main_menu())
-    finally:
-        sess.close()
+    if not rows:
+        bot.send_message(uid, "На неделю задач нет.", reply_markup=MAIN_MENU); return
+    out = []
+    # строки уже упорядочены по дате в SQL — группируем одним проходом; строки всех дней
+    # собираются в один список и склеиваются одним join
+    for d, grp in groupby(rows, key=lambda t: t.date):
+        out.extend(grouped_lines(list(grp), dstr(d))); out.append("")
+    bot.send_message(uid, "\n".join(out), reply_markup=MAIN_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "➕ Добавить")
 def add(m):
@@ -530,91 +800,124 @@ def add(m):
     bot.register_next_step_handler(sent, add_text)
 
 def add_text(m):
-    sess = SessionLocal()
-    try:
-        uid = m.chat.id
-        items = ai_parse_items(m.text.strip(), uid)
-        created = 0; templates = 0
+    uid = m.chat.id; text = m.text.strip()
+    if not openai_client:
+        bot.send_message(uid, _add_items(uid, text), reply_markup=MAIN_MENU); return
+    # разбор через OpenAI занимает 1-3с — не держим поток обработчика; по готовности заглушку
+    # убираем, а итог шлём новым сообщением: edit не может вернуть reply-клавиатуру MAIN_MENU
+    ph = bot.send_message(uid, "⏳ Обрабатываю…")
+    def _finish(fut):
+        try: msg = fut.result()
+        except Exception as e:
+            log.warning("add_text fail: %s", e); msg = "⚠️ Не удалось добавить задачу."
+        try: bot.delete_message(uid, ph.message_id)
+        except Exception: pass
+        try: bot.send_message(uid, msg, reply_markup=MAIN_MENU)
+        except Exception as e: log.warning("add_text send error: %s", e)
+    _AI_POOL.submit(_add_items, uid, text).add_done_callback(_finish)
+
+# COPY ... FROM STDIN: для больших пачек (AI разобрал десятки пунктов) быстрее INSERT VALUES.
+# Колонки с Python-дефолтами (status и пр.) COPY сам не заполнит — перечислены явно.
+COPY_THRESHOLD = 50
+_COPY_COLS = ("user_id","date","category","subcategory","text","deadline","repeat_rule","source",
+              "is_repeating","task_type","priority","status")
+# в CSV пустое без кавычек = NULL; для строковых колонок "" должно остаться пустой строкой
+_COPY_SQL = (f"COPY tasks ({','.join(_COPY_COLS)}) FROM STDIN WITH (FORMAT csv, "
+             f"FORCE_NOT_NULL (category,subcategory,text,repeat_rule,source,task_type,priority,status))")
+
+def _copy_tasks(sess, rows):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for r in rows:
+        w.writerow([r.get(c, "") for c in _COPY_COLS])  # None (deadline) → пусто → NULL
+    buf.seek(0)
+    # сырое psycopg2-соединение той же транзакции сессии: commit ниже фиксирует и COPY
+    with sess.connection().connection.cursor() as cur:
+        cur.copy_expert(_COPY_SQL, buf)
+
+def _add_items(uid, text):
+    items = ai_parse_items(text, uid)  # до открытия сессии: соединение не ждёт OpenAI
+    with db() as sess:
+        today = now_local().date()
+        rows = []
         for it in items:
-            dt = parse_date(it["date"]) if it["date"] else now_local().date()
+            dt = parse_date(it["date"]) if it["date"] else today
             tm = parse_time(it["time"]) if it["time"] else None
             is_rep = bool((it.get("repeat") or "").strip())
             # NEW: дефолты для новых полей
-            t = Task(user_id=uid, date=dt, category=it["category"], subcategory=it["subcategory"],
-                     text=it["task"], deadline=tm, repeat_rule=it["repeat"], source=it["supplier"],
-                     is_repeating=is_rep, task_type=("purchase" if it.get("supplier") else "todo"),
-                     priority=("high" if it.get("supplier") else "medium"))
-            sess.add(t)
-            if is_rep: templates += 1
-            else: created += 1
+            rows.append(dict(user_id=uid, date=dt, category=it["category"], subcategory=it["subcategory"],
+                             text=it["task"], deadline=tm, repeat_rule=it["repeat"], source=it["supplier"],
+                             is_repeating=is_rep, task_type=("purchase" if it.get("supplier") else "todo"),
+                             priority=("high" if it.get("supplier") else "medium")))
+        if len(rows) >= COPY_THRESHOLD and _PG_BATCH:
+            _copy_tasks(sess, rows)
+        elif rows:
+            sess.execute(insert(Task), rows)
         sess.commit()
+        templates = sum(1 for r in rows if r["is_repeating"])
+        created = len(rows) - templates
         msg = f"✅ Добавлено задач: {created}."
         if templates: msg += f" Создано шаблонов повторения: {templates}."
-        bot.send_message(uid, msg, reply_markup=main_menu())
-    finally:
-        sess.close()
+        return msg
 
 @bot.message_handler(func=lambda msg: msg.text == "✅ Я сделал…")
 def done_free(m):
     sent = bot.send_message(m.chat.id, "Напиши что именно сделал (например: сделал заказы к-экспро центр).")
     bot.register_next_step_handler(sent, done_text)
 
+# одно регулярное выражение (Postgres ~*) вместо цепочки ILIKE по каждому слову
+_ORDER_PAT = "заказ|закуп"
+_DONE_PAT = "заказ|закуп|сделал"
+
 def done_text(m):
-    sess = SessionLocal()
-    try:
-        uid = m.chat.id
-        txt = (m.text or "").lower()
-        supplier = ""
-        if any(x in txt for x in ["к-экспро","k-exp","к экспро"]): supplier = "К-Экспро"
-        if "вылегжан" in txt: supplier = "ИП Вылегжанина"
-        rows = tasks_for_date(sess, uid, now_local().date())
-        changed = 0; last = None
-        for t in rows:
-            if t.status=="выполнено": continue
-            low = (t.text or "").lower()
-            is_order = ("заказ" in low or "закуп" in low)
-            if supplier:
-                if norm_sup(supplier) not in norm_sup(low): continue
-                if not is_order: continue
-            elif not any(w in low for w in ["заказ","закуп","сделал"]):
-                continue
-            t.status = "выполнено"; last = t; changed += 1
+    uid = m.chat.id
+    txt = (m.text or "").lower()
+    supplier = detect_supplier(txt)
+    today_d = now_local().date()
+    match = (and_(Task.text.icontains(norm_sup(supplier), autoescape=True),
+                  Task.text.regexp_match(_ORDER_PAT, flags="i")) if supplier
+             else Task.text.regexp_match(_DONE_PAT, flags="i"))
+    with db() as sess:
+        # отбор и отметка одним UPDATE … RETURNING: один запрос, а параллельный апдейт того же
+        # пользователя после блокировки перепроверит WHERE и не посчитает задачи дважды
+        rows = sess.execute(
+            update(Task)
+            .where(Task.user_id==uid, Task.date==today_d, Task.is_repeating==False,
+                   func.coalesce(Task.status, "")!="выполнено", match)
+            .values(status="выполнено")
+            .returning(Task.id, Task.category, Task.subcategory, Task.deadline, Task.text)
+            .execution_options(synchronize_session=False)
+        ).all()
         sess.commit()
+        changed = len(rows)
         msg = f"✅ Отмечено выполненным: {changed}."
-        if changed and supplier and last:
-            created = plan_next(sess, uid, supplier, last.category, last.subcategory)
+        if changed and supplier:
+            # порядок RETURNING не гарантирован — «последняя» задача по TASK_ORDER, как в списках
+            last = max(rows, key=task_order_key)
+            created = plan_next(sess, uid, supplier, last.category, last.subcategory, today_d)
             if created: msg += " Запланирована приемка/следующий заказ."
-        bot.send_message(uid, msg, reply_markup=main_menu())
-    finally:
-        sess.close()
+    bot.send_message(uid, msg, reply_markup=MAIN_MENU)
 
 # ----- Поставки -----
 @bot.message_handler(func=lambda msg: msg.text == "🚚 Поставки")
 def supplies_menu(m):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("📦 Заказы сегодня","🆕 Добавить поставщика")
-    kb.row("⬅️ Назад")
-    bot.send_message(m.chat.id, "Меню поставок:", reply_markup=kb)
+    bot.send_message(m.chat.id, "Меню поставок:", reply_markup=SUPPLIES_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "⬅️ Назад")
 def back_main(m):
-    bot.send_message(m.chat.id, "Ок.", reply_markup=main_menu())
+    bot.send_message(m.chat.id, "Ок.", reply_markup=MAIN_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "📦 Заказы сегодня")
 def orders_today(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
-        rows = tasks_for_date(sess, uid, now_local().date())
-        orders = [t for t in rows if "заказ" in (t.text or "").lower()]
+        orders = tasks_for_date(sess, uid, now_local().date(), Task.text.ilike("%заказ%"))
         if not orders:
-            bot.send_message(uid, "На сегодня заказов нет.", reply_markup=main_menu()); return
+            bot.send_message(uid, "На сегодня заказов нет.", reply_markup=MAIN_MENU); return
         items = [(short_line(t, i), t.id) for i,t in enumerate(orders, start=1)]
         total = (len(items)+PAGE-1)//PAGE or 1
         kb = page_kb(items[:PAGE], 1, total, "open")
         bot.send_message(uid, "Заказы на сегодня:", reply_markup=kb)
-    finally:
-        sess.close()
 
 @bot.message_handler(func=lambda msg: msg.text == "🆕 Добавить поставщика")
 def add_supplier(m):
@@ -627,20 +930,18 @@ def add_supplier(m):
     bot.register_next_step_handler(sent, add_supplier_parse)
 
 def add_supplier_parse(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         parts = [p.strip() for p in (m.text or "").split(";")]
         if len(parts) < 8:
-            bot.send_message(m.chat.id, "Ошибка формата. Нужны 8 полей.", reply_markup=main_menu()); return
+            bot.send_message(m.chat.id, "Ошибка формата. Нужны 8 полей.", reply_markup=MAIN_MENU); return
         name, rule, deadline, emoji, offs, shelf, auto, active = parts[:8]
-        s = sess.query(Supplier).filter(func.lower(Supplier.name)==name.strip().lower()).first() or Supplier(name=name.strip())
+        s = sess.query(Supplier).filter(func.lower(Supplier.name)==norm_sup(name)).first() or Supplier(name=name.strip())
         s.rule = rule; s.order_deadline = deadline; s.emoji = emoji
         s.delivery_offset_days = int(offs or 1); s.shelf_days = int(shelf or 0)
         s.auto = bool(int(auto)); s.active = bool(int(active))
         sess.add(s); sess.commit()
-        bot.send_message(m.chat.id, "✅ Поставщик сохранён.", reply_markup=main_menu())
-    finally:
-        sess.close()
+        sup_cache_invalidate()
+        bot.send_message(m.chat.id, "✅ Поставщик сохранён.", reply_markup=MAIN_MENU)
 
 # ----- Поиск / Ассистент -----
 @bot.message_handler(func=lambda msg: msg.text == "🔎 Найти")
@@ -649,10 +950,9 @@ def search_prompt(m):
     bot.register_next_step_handler(sent, do_search)
 
 def do_search(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id; q = (m.text or "").strip()
-        ds = re.search(r"(\d{2}\.\d{2}\.\d{4})", q)
+        ds = _RE_DATE.search(q)
         conds = [Task.user_id==uid, Task.is_repeating==False]
         if ds: conds.append(Task.date==parse_date(ds.group(1)))
         if "/" in q:
@@ -662,63 +962,52 @@ def do_search(m):
             conds.append(or_(Task.text.ilike(f"%{q}%"),
                              Task.category.ilike(f"%{q}%"),
                              Task.subcategory.ilike(f"%{q}%")))
-        rows = (sess.query(Task).filter(and_(*conds))
-                .order_by(Task.date.asc(), Task.category.asc(), Task.subcategory.asc()).all())
-        if not rows:
-            bot.send_message(uid, "Ничего не найдено.", reply_markup=main_menu()); return
-        by = {}
-        for t in rows: by.setdefault(dstr(t.date), []).append(t)
-        parts = []
-        for ds in sorted(by.keys(), key=lambda s: parse_date(s)):
-            parts.append(format_grouped(by[ds], header_date=ds)); parts.append("")
-        bot.send_message(uid, "\n".join(parts), reply_markup=main_menu())
-    finally:
-        sess.close()
+        rows = sess.execute(select(*TASK_VIEW_COLS).where(*conds)
+                            .order_by(Task.date.asc(), *TASK_ORDER)).all()
+    if not rows:
+        bot.send_message(uid, "Ничего не найдено.", reply_markup=MAIN_MENU); return
+    out = []
+    # как в week(): строки уже по дате из SQL — без dict по dstr и обратного parse_date в сортировке
+    for d, grp in groupby(rows, key=lambda t: t.date):
+        out.extend(grouped_lines(list(grp), dstr(d))); out.append("")
+    bot.send_message(uid, "\n".join(out), reply_markup=MAIN_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "🧠 Ассистент")
 def assistant(m):
-    sent = bot.send_message(m.chat.id, "Спроси меня о приоритете/плане. Я учту твою неделю.", reply_markup=main_menu())
+    sent = bot.send_message(m.chat.id, "Спроси меня о приоритете/плане. Я учту твою неделю.", reply_markup=MAIN_MENU)
     bot.register_next_step_handler(sent, assistant_answer)
 
 def assistant_answer(m):
     uid = m.chat.id
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         base = now_local().date()
         rows = tasks_for_week(sess, uid, base)
-        context_lines = []
-        for t in rows[:200]:
-            context_lines.append(f"{dstr(t.date)} | {t.category}/{t.subcategory or '—'} | {t.text} | до {tstr(t.deadline)} | {t.status or '—'}")
-        question = m.text or ""
-        if openai_client:
-            try:
-                system = ("Ты ассистент‑планировщик. Кратко (маркерами) дай приоритеты, сроки, предупреждения по дедлайнам. Русским языком.")
-                user = "Контекст задач на неделю:\n" + "\n".join(context_lines) + "\n\nВопрос:\n" + question
-                resp = openai_client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[{"role":"system","content":system},{"role":"user","content":user}],
-                    temperature=0.2
-                )
-                bot.send_message(uid, resp.choices[0].message.content.strip(), reply_markup=main_menu())
-                return
-            except Exception as e:
-                log.warning("assistant fail: %s", e)
-        bot.send_message(uid, "• Начни с задач с временем до 12:00.\n• Далее — «Заказы» поставщиков (до дедлайнов).\n• Потом личные без срока.", reply_markup=main_menu())
-    finally:
-        sess.close()
+    # сессия закрыта до вызова OpenAI — соединение не простаивает на ответе модели
+    context_lines = []
+    for t in rows[:200]:
+        context_lines.append(f"{dstr(t.date)} | {t.category}/{t.subcategory or '—'} | {t.text} | до {tstr(t.deadline)} | {t.status or '—'}")
+    question = m.text or ""
+    if openai_client:
+        try:
+            system = ("Ты ассистент‑планировщик. Кратко (маркерами) дай приоритеты, сроки, предупреждения по дедлайнам. Русским языком.")
+            user = "Контекст задач на неделю:\n" + "\n".join(context_lines) + "\n\nВопрос:\n" + question
+            resp = openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role":"system","content":system},{"role":"user","content":user}],
+                temperature=0.2, timeout=AI_TIMEOUT
+            )
+            bot.send_message(uid, resp.choices[0].message.content.strip(), reply_markup=MAIN_MENU)
+            return
+        except Exception as e:
+            log.warning("assistant fail: %s", e)
+    bot.send_message(uid, "• Начни с задач с временем до 12:00.\n• Далее — «Заказы» поставщиков (до дедлайнов).\n• Потом личные без срока.", reply_markup=MAIN_MENU)
 
 # ----- Профиль / Делегирование / Зависимости -----
 @bot.message_handler(func=lambda msg: msg.text == "👤 Профиль")
 def profile(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         u = ensure_user(sess, m.chat.id)
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.row("🕒 TZ", "📨 Дайджест 08:00")
-        kb.row("⬅️ Назад")
-        bot.send_message(m.chat.id, f"Твой профиль:\n• TZ: {u.tz}\n• Дайджест 08:00: {'вкл' if u.digest_08 else 'выкл'}", reply_markup=kb)
-    finally:
-        sess.close()
+        bot.send_message(m.chat.id, f"Твой профиль:\n• TZ: {u.tz}\n• Дайджест 08:00: {'вкл' if u.digest_08 else 'выкл'}", reply_markup=PROFILE_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "🕒 TZ")
 def profile_tz(m):
@@ -726,29 +1015,23 @@ def profile_tz(m):
     bot.register_next_step_handler(sent, profile_tz_set)
 
 def profile_tz_set(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         tz = (m.text or "").strip()
         try:
-            pytz.timezone(tz)
+            ZoneInfo(tz)  # сам кеширует зоны по имени
         except Exception:
-            bot.send_message(m.chat.id, "Некорректная TZ. Пример: Europe/Moscow", reply_markup=main_menu()); return
+            bot.send_message(m.chat.id, "Некорректная TZ. Пример: Europe/Moscow", reply_markup=MAIN_MENU); return
         u = ensure_user(sess, m.chat.id)
         u.tz = tz; sess.commit()
-        bot.send_message(m.chat.id, f"✅ TZ обновлена: {tz}", reply_markup=main_menu())
-    finally:
-        sess.close()
+        bot.send_message(m.chat.id, f"✅ TZ обновлена: {tz}", reply_markup=MAIN_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "📨 Дайджест 08:00")
 def profile_digest_toggle(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         u = ensure_user(sess, m.chat.id)
         u.digest_08 = not (u.digest_08 or False)
         sess.commit()
-        bot.send_message(m.chat.id, f"Дайджест теперь: {'вкл' if u.digest_08 else 'выкл'}", reply_markup=main_menu())
-    finally:
-        sess.close()
+        bot.send_message(m.chat.id, f"Дайджест теперь: {'вкл' if u.digest_08 else 'выкл'}", reply_markup=MAIN_MENU)
 
 @bot.message_handler(func=lambda msg: msg.text == "🤝 Делегирование")
 def delegation_menu(m):
@@ -758,23 +1041,20 @@ def delegation_menu(m):
     bot.register_next_step_handler(sent, delegation_set)
 
 def delegation_set(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
         parts = (m.text or "").strip().split()
         if len(parts)!=2 or not parts[0].isdigit() or not parts[1].isdigit():
-            bot.send_message(uid, "Формат: <assignee_chat_id> <task_id>", reply_markup=main_menu()); return
+            bot.send_message(uid, "Формат: <assignee_chat_id> <task_id>", reply_markup=MAIN_MENU); return
         assignee = int(parts[0]); tid = int(parts[1])
-        t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
+        t = own_task(sess, tid, uid)
         if not t:
-            bot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+            bot.send_message(uid, "Задача не найдена.", reply_markup=MAIN_MENU); return
         t.assignee_id = assignee; sess.commit()
-        bot.send_message(uid, f"✅ Задача делегирована {assignee}.", reply_markup=main_menu())
+        bot.send_message(uid, f"✅ Задача делегирована {assignee}.", reply_markup=MAIN_MENU)
         try:
             bot.send_message(assignee, f"Вам делегирована задача от {uid}: «{t.text}» на {dstr(t.date)} (до {tstr(t.deadline)})")
         except Exception: pass
-    finally:
-        sess.close()
 
 @bot.message_handler(func=lambda msg: msg.text == "🧩 Зависимости")
 def deps_menu(m):
@@ -784,72 +1064,75 @@ def deps_menu(m):
     bot.register_next_step_handler(sent, deps_set)
 
 def deps_set(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
         parts = (m.text or "").strip().split()
         if len(parts)!=2 or not all(p.isdigit() for p in parts):
-            bot.send_message(uid, "Формат: <child_task_id> <parent_task_id>", reply_markup=main_menu()); return
+            bot.send_message(uid, "Формат: <child_task_id> <parent_task_id>", reply_markup=MAIN_MENU); return
         child, parent = map(int, parts)
-        ct = sess.query(Task).filter(Task.id==child, Task.user_id==uid).first()
-        pt = sess.query(Task).filter(Task.id==parent, Task.user_id==uid).first()
+        ct = own_task(sess, child, uid)
+        pt = own_task(sess, parent, uid)
         if not ct or not pt:
-            bot.send_message(uid, "Задача(и) не найдены.", reply_markup=main_menu()); return
+            bot.send_message(uid, "Задача(и) не найдены.", reply_markup=MAIN_MENU); return
         sess.add(Dependency(task_id=child, depends_on_id=parent)); sess.commit()
-        bot.send_message(uid, "✅ Зависимость добавлена.", reply_markup=main_menu())
-    finally:
-        sess.close()
+        bot.send_message(uid, "✅ Зависимость добавлена.", reply_markup=MAIN_MENU)
 
 # ----- Callbacks (карточки) -----
-@bot.callback_query_handler(func=lambda c: True)
+def answer_cb(c, msg=None, alert=False):
+    # снять «часики» с кнопки; на один callback — один ответ, ошибка (истёк и т.п.) не критична
+    try:
+        bot.answer_callback_query(c.id, msg, show_alert=alert)
+    except Exception as e:
+        log.warning("answer_callback_query error: %s", e)
+
+def _is_rule_cb(c):
+    d = parse_cb(c.data) if c.data else None
+    return bool(d) and d.get("a","").startswith("r_")
+
+# telebot берёт первый подходящий обработчик: r_* отдаём rules_callbacks (он объявлен ниже)
+@bot.callback_query_handler(func=lambda c: not _is_rule_cb(c))
 def cb(c):
-    data = parse_cb(c.data) if c.data and c.data!="noop" else None
+    data = parse_cb(c.data)
     uid = c.message.chat.id
     if not data:
-        bot.answer_callback_query(c.id); return
+        answer_cb(c); return
     a = data.get("a")
-    sess = SessionLocal()
-    try:
+    # кнопки-вопросы БД не трогают: только подсказка и next-step — сессию не открываем
+    prompt = _CB_PROMPTS.get(a)
+    if prompt:
+        answer_cb(c)
+        sent = bot.send_message(uid, prompt[0])
+        bot.register_next_step_handler(sent, prompt[1], int(data.get("id")))
+        return
+    with db() as sess:
         if a=="open":
             tid = int(data.get("id"))
-            t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-            if not t: bot.answer_callback_query(c.id, "Не найдено", show_alert=True); return
+            t = own_task(sess, tid, uid)
+            if not t: answer_cb(c, "Не найдено", alert=True); return
+            answer_cb(c)  # ответ до зависимостей и send_message — клиент сразу снимает «часики»
             dl = tstr(t.deadline)
-            deps = sess.query(Dependency).filter(Dependency.task_id==t.id).all()
-            dep_text = ""
-            if deps:
-                dep_ids = [str(d.depends_on_id) for d in deps]
-                dep_text = f"\n🔗 Зависит от: {', '.join(dep_ids)}"
-            pr_emoji = {"high":"🔴","medium":"🟡","low":"🟢","future":"⏳"}.get(t.priority or "medium","🟡")
+            dep_ids = sess.scalars(select(Dependency.depends_on_id).where(Dependency.task_id==t.id)).all()
+            dep_text = f"\n🔗 Зависит от: {', '.join(map(str, dep_ids))}" if dep_ids else ""
             text = (f"<b>{t.text}</b>\n"
                     f"📅 {weekday_ru(t.date)} — {dstr(t.date)}\n"
                     f"📁 {t.category}/{t.subcategory or '—'}\n"
-                    f"⚑ Тип: {t.task_type or 'todo'}  • Приоритет: {pr_emoji}\n"
+                    f"⚑ Тип: {t.task_type or 'todo'}  • Приоритет: {pr_emoji(t.priority)}\n"
                     f"⏰ Дедлайн: {dl}\n"
                     f"📝 Статус: {t.status or '—'}{dep_text}")
-            kb = types.InlineKeyboardMarkup()
-            kb.row(types.InlineKeyboardButton("✅ Выполнить", callback_data=mk_cb("done", id=tid)),
-                   types.InlineKeyboardButton("🗑 Удалить", callback_data=mk_cb("del", id=tid)))
-            kb.row(types.InlineKeyboardButton("✏️ Дедлайн", callback_data=mk_cb("setdl", id=tid)),
-                   types.InlineKeyboardButton("⏰ Напоминание", callback_data=mk_cb("rem", id=tid)))
-            # быстрый перенос (минимум)
-            kb.row(types.InlineKeyboardButton("📤 Сегодня", callback_data=mk_cb("mv", id=tid, to="today")),
-                   types.InlineKeyboardButton("📤 Завтра",  callback_data=mk_cb("mv", id=tid, to="tomorrow")),
-                   types.InlineKeyboardButton("📤 +1д",     callback_data=mk_cb("mv", id=tid, to="+1")))
-            bot.answer_callback_query(c.id)
-            bot.send_message(uid, text, reply_markup=kb)
+            bot.send_message(uid, text, reply_markup=open_kb(tid))
             return
         if a=="mv":
             tid = int(data.get("id")); to = data.get("to")
-            t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-            if not t: bot.answer_callback_query(c.id, "Не найдено", show_alert=True); return
+            t = own_task(sess, tid, uid)
+            if not t: answer_cb(c, "Не найдено", alert=True); return
             base = now_local().date()
             if to=="today": t.date = base
             elif to=="tomorrow": t.date = base + timedelta(days=1)
             elif to=="+1": t.date = t.date + timedelta(days=1)
             sess.commit()
-            bot.answer_callback_query(c.id, "Перенесено"); return
+            answer_cb(c, "Перенесено"); return
         if a=="page":
+            answer_cb(c)
             rows = tasks_for_date(sess, uid, now_local().date())
             items = [(short_line(t, i), t.id) for i,t in enumerate(rows, start=1)]
             page = int(data.get("p",1))
@@ -861,125 +1144,103 @@ def cb(c):
                 bot.edit_message_reply_markup(uid, c.message.message_id, reply_markup=kb)
             except Exception:
                 pass
-            bot.answer_callback_query(c.id); return
+            return
         if a=="done":
             tid = int(data.get("id"))
-            t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-            if not t: bot.answer_callback_query(c.id, "Не найдено", show_alert=True); return
-            deps = sess.query(Dependency).filter(Dependency.task_id==t.id).all()
-            if deps:
-                undone = sess.query(Task).filter(Task.id.in_([d.depends_on_id for d in deps]),
-                                                 Task.status!="выполнено").count()
-                if undone>0:
-                    bot.answer_callback_query(c.id, "Есть невыполненные зависимости.", show_alert=True); return
+            t = own_task(sess, tid, uid)
+            if not t: answer_cb(c, "Не найдено", alert=True); return
+            # одна проверка EXISTS по join вместо списка зависимостей + count по нему
+            blocked = sess.scalar(select(exists().where(Dependency.task_id==t.id,
+                                                        Task.id==Dependency.depends_on_id,
+                                                        Task.status!="выполнено")))
+            if blocked:
+                answer_cb(c, "Есть невыполненные зависимости.", alert=True); return
             t.status = "выполнено"; sess.commit()
-            sup = ""
-            low = (t.text or "").lower()
-            if any(x in low for x in ["к-экспро","k-exp","к экспро"]): sup="К-Экспро"
-            if "вылегжан" in low: sup="ИП Вылегжанина"
+            sup = detect_supplier(t.text or "")
             msg = "✅ Готово."
             if sup:
                 created = plan_next(sess, uid, sup, t.category, t.subcategory)
                 if created: msg += " Запланирована приемка/следующий заказ."
-            bot.answer_callback_query(c.id, msg, show_alert=True); return
+            answer_cb(c, msg, alert=True); return
         if a=="del":
             tid = int(data.get("id"))
-            t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-            if not t: bot.answer_callback_query(c.id, "Не найдено", show_alert=True); return
+            t = own_task(sess, tid, uid)
+            if not t: answer_cb(c, "Не найдено", alert=True); return
             sess.delete(t); sess.commit()
-            bot.answer_callback_query(c.id, "Удалено", show_alert=True); return
-        if a=="setdl":
-            tid = int(data.get("id"))
-            bot.answer_callback_query(c.id)
-            sent = bot.send_message(uid, "Введи время в формате ЧЧ:ММ")
-            bot.register_next_step_handler(sent, set_deadline_text, tid)
-            return
-        if a=="rem":
-            tid = int(data.get("id"))
-            bot.answer_callback_query(c.id)
-            sent = bot.send_message(uid, "Введи напоминание: ДД.ММ.ГГГГ ЧЧ:ММ")
-            bot.register_next_step_handler(sent, add_reminder_text, tid)
-            return
-        if a=="sub":
-            tid = int(data.get("id"))
-            bot.answer_callback_query(c.id)
-            sent = bot.send_message(uid, "Текст подзадачи:")
-            bot.register_next_step_handler(sent, add_subtask_text, tid)
-            return
-        if a=="dlg":
-            tid = int(data.get("id"))
-            bot.answer_callback_query(c.id)
-            sent = bot.send_message(uid, "Кому делегировать? Введи chat_id получателя.")
-            bot.register_next_step_handler(sent, delegate_to_user, tid)
-            return
-    finally:
-        sess.close()
+            answer_cb(c, "Удалено", alert=True); return
 
 def set_deadline_text(m, tid):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
         try:
             tm = parse_time(m.text.strip())
         except Exception:
-            bot.send_message(uid, "Формат времени: ЧЧ:ММ", reply_markup=main_menu()); return
-        t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+            bot.send_message(uid, "Формат времени: ЧЧ:ММ", reply_markup=MAIN_MENU); return
+        t = own_task(sess, tid, uid)
+        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=MAIN_MENU); return
         t.deadline = tm; sess.commit()
-        bot.send_message(uid, "⏰ Дедлайн обновлён.", reply_markup=main_menu())
-    finally:
-        sess.close()
+        bot.send_message(uid, "⏰ Дедлайн обновлён.", reply_markup=MAIN_MENU)
 
 def add_reminder_text(m, tid):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
         try:
             parts = m.text.strip().split()
             dt = parse_date(parts[0]); tm = parse_time(parts[1])
         except Exception:
-            bot.send_message(uid, "Формат: ДД.ММ.ГГГГ ЧЧ:ММ", reply_markup=main_menu()); return
-        t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+            bot.send_message(uid, "Формат: ДД.ММ.ГГГГ ЧЧ:ММ", reply_markup=MAIN_MENU); return
+        t = own_task(sess, tid, uid)
+        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=MAIN_MENU); return
         sess.add(Reminder(user_id=uid, task_id=tid, date=dt, time=tm, fired=False))
         sess.commit()
-        bot.send_message(uid, "🔔 Напоминание создано.", reply_markup=main_menu())
-    finally:
-        sess.close()
+        bot.send_message(uid, "🔔 Напоминание создано.", reply_markup=MAIN_MENU)
 
 def add_subtask_text(m, tid):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
-        t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+        t = own_task(sess, tid, uid)
+        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=MAIN_MENU); return
         sess.add(Subtask(task_id=tid, text=(m.text or "").strip(), status=""))
         sess.commit()
-        bot.send_message(uid, "➕ Подзадача добавлена.", reply_markup=main_menu())
-    finally:
-        sess.close()
+        bot.send_message(uid, "➕ Подзадача добавлена.", reply_markup=MAIN_MENU)
 
 def delegate_to_user(m, tid):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
         try:
             assignee = int((m.text or "").strip())
         except Exception:
-            bot.send_message(uid, "Нужен числовой chat_id.", reply_markup=main_menu()); return
-        t = sess.query(Task).filter(Task.id==tid, Task.user_id==uid).first()
-        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=main_menu()); return
+            bot.send_message(uid, "Нужен числовой chat_id.", reply_markup=MAIN_MENU); return
+        t = own_task(sess, tid, uid)
+        if not t: bot.send_message(uid, "Задача не найдена.", reply_markup=MAIN_MENU); return
         t.assignee_id = assignee; sess.commit()
-        bot.send_message(uid, f"✅ Делегировано: {assignee}", reply_markup=main_menu())
+        bot.send_message(uid, f"✅ Делегировано: {assignee}", reply_markup=MAIN_MENU)
         try:
             bot.send_message(assignee, f"Вам делегирована задача от {uid}: «{t.text}» на {dstr(t.date)} (до {tstr(t.deadline)})")
         except Exception: pass
-    finally:
-        sess.close()
+# действие → (подсказка, обработчик ответа с id задачи)
+_CB_PROMPTS = {
+    "setdl": ("Введи время в формате ЧЧ:ММ", set_deadline_text),
+    "rem":   ("Введи напоминание: ДД.ММ.ГГГГ ЧЧ:ММ", add_reminder_text),
+    "sub":   ("Текст подзадачи:", add_subtask_text),
+    "dlg":   ("Кому делегировать? Введи chat_id получателя.", delegate_to_user),
+}
+
 # ===== Rules UI (список/добавить/управление) =====
 RULE_WIZ = {}      # uid -> {"step":..., "data":{...}}
 RULE_EDIT = {}     # uid -> {"field":..., "rule_id":...}
 
+# Статичные кнопки мастера: подписанные callback_data считаем один раз при импорте
+WIZ_DAYS = (("пн","Пн"),("вт","Вт"),("ср","Ср"),("чт","Чт"),("пт","Пт"),("сб","Сб"),("вс","Вс"))
+CB_R_ADD, CB_R_BACK, CB_R_CANCEL, CB_R_WD_DONE = (mk_cb(a) for a in ("r_add","r_back","r_cancel","r_wd_done"))
+CB_R_DIR_NONE, CB_R_SUP_NONE = mk_cb("r_dir", id=0), mk_cb("r_sup", id=0)
+CB_R_TYPE = {v: mk_cb("r_type", v=v) for v in ("todo","purchase")}
+CB_R_PER = {v: mk_cb("r_per", v=v) for v in ("daily","weekdays","every_n_days")}
+CB_R_TIME_SET = {v: mk_cb("r_time_set", v=v) for v in ("none","ask")}
+CB_R_BEFORE = {m: mk_cb("r_before", v=m) for m in (0,5,10,30,60)}
+CB_R_AUTO_SET = {v: mk_cb("r_auto_set", v=v) for v in (1,0)}
+CB_R_WD = {code: mk_cb("r_wd", d=code) for code,_ in WIZ_DAYS}
+
 def rule_brief(r: Rule) -> str:
     per = {"daily":"ежедневно","weekdays":f"по {r.weekdays or '—'}","every_n_days":f"каждые {r.every_n or '?'} дн."}.get(r.periodicity, r.periodicity)
     auto = "on" if r.auto_create else "off"
@@ -1019,101 +1280,99 @@ def rules_list_kb(rules, page=1, per_page=6):
     nav = []
     if page>1:
         nav.append(types.InlineKeyboardButton("⬅️", callback_data=mk_cb("r_page", p=page-1)))
-    nav.append(types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data="noop"))
+    nav.append(types.InlineKeyboardButton(f"{page}/{total_pages}", callback_data=_NOOP))
     if page<total_pages:
         nav.append(types.InlineKeyboardButton("➡️", callback_data=mk_cb("r_page", p=page+1)))
     if nav: kb.row(*nav)
-    kb.row(types.InlineKeyboardButton("➕ Добавить правило", callback_data=mk_cb("r_add")))
+    kb.row(types.InlineKeyboardButton("➕ Добавить правило", callback_data=CB_R_ADD))
     return kb, page, total_pages
 
+def user_rules(sess, uid):
+    return (sess.query(Rule)
+            .options(selectinload(Rule.direction), selectinload(Rule.supplier))
+            .filter(Rule.user_id==uid)
+            .order_by(Rule.active.desc(), Rule.id.desc())
+            .all())
+
+def rules_page(rules, page=1, per_page=6):
+    # одна страница — одно сообщение: карточки текстом + кнопки/навигация из rules_list_kb
+    kb, page, total = rules_list_kb(rules, page, per_page)
+    text = f"⚙️ Твои правила ({page}/{total}):"
+    for r in rules[(page-1)*per_page:page*per_page]:
+        brief = rule_brief(r)
+        if len(text) + 2 + len(brief) > TG_MAX_TEXT: break  # остальное — по ℹ️ #id
+        text += "\n\n" + brief
+    return text, kb
+
 @bot.message_handler(func=lambda msg: msg.text == "⚙️ Правила")
 def rules_menu(m):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         uid = m.chat.id
-        rules = (sess.query(Rule)
-                 .filter(Rule.user_id==uid)
-                 .order_by(Rule.active.desc(), Rule.id.desc())
-                 .all())
+        rules = user_rules(sess, uid)
         if not rules:
             kb = types.InlineKeyboardMarkup()
-            kb.add(types.InlineKeyboardButton("➕ Добавить правило", callback_data=mk_cb("r_add")))
-            bot.send_message(uid, "Правил пока нет.", reply_markup=main_menu())
+            kb.add(types.InlineKeyboardButton("➕ Добавить правило", callback_data=CB_R_ADD))
+            bot.send_message(uid, "Правил пока нет.", reply_markup=MAIN_MENU)
             bot.send_message(uid, "Создать новое правило:", reply_markup=kb)
             return
-        text = "⚙️ Твои правила:"
-        kb, page, total = rules_list_kb(rules, 1)
-        bot.send_message(uid, text, reply_markup=main_menu())
-        # отправим краткие карточки пачкой
-        for r in rules[:6]:
-            bot.send_message(uid, rule_brief(r), reply_markup=types.InlineKeyboardMarkup().add(
-                types.InlineKeyboardButton("Открыть действия", callback_data=mk_cb("r_info", id=r.id))
-            ))
-        bot.send_message(uid, "Навигация по правилам:", reply_markup=kb)
-    finally:
-        sess.close()
+        text, kb = rules_page(rules, 1)
+    bot.send_message(uid, text, reply_markup=kb)
 
 # ---- Wizard "add rule" ----
 def r_wiz_reset(uid): RULE_WIZ.pop(uid, None)
 def r_wiz(uid): return RULE_WIZ.setdefault(uid, {"step":"dir","data":{}})
 
 def ask_direction(chat_id):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         dirs = sess.query(Direction).order_by(Direction.sort_order.asc()).all()
-    finally:
-        sess.close()
     kb = types.InlineKeyboardMarkup(row_width=2)
     for d in dirs:
         kb.add(types.InlineKeyboardButton(f"{d.emoji or '📂'} {d.name}", callback_data=mk_cb("r_dir", id=d.id)))
-    kb.add(types.InlineKeyboardButton("— Без направления —", callback_data=mk_cb("r_dir", id=0)))
-    kb.add(types.InlineKeyboardButton("❌ Отмена", callback_data=mk_cb("r_cancel")))
+    kb.add(types.InlineKeyboardButton("— Без направления —", callback_data=CB_R_DIR_NONE))
+    kb.add(types.InlineKeyboardButton("❌ Отмена", callback_data=CB_R_CANCEL))
     send_safe("Шаг 1/8: Выбери направление", chat_id, reply_markup=kb)
 
 def ask_type(chat_id):
     kb = types.InlineKeyboardMarkup()
     kb.add(
-        types.InlineKeyboardButton("📌 Обычное дело", callback_data=mk_cb("r_type", v="todo")),
-        types.InlineKeyboardButton("📦 Закупка", callback_data=mk_cb("r_type", v="purchase")),
+        types.InlineKeyboardButton("📌 Обычное дело", callback_data=CB_R_TYPE["todo"]),
+        types.InlineKeyboardButton("📦 Закупка", callback_data=CB_R_TYPE["purchase"]),
     )
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=mk_cb("r_back")))
+    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=CB_R_BACK))
     send_safe("Шаг 2/8: Выбери тип", chat_id, reply_markup=kb)
 
 def ask_supplier(chat_id, direction_id):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         q = sess.query(Supplier)
         if direction_id:
             q = q.filter(Supplier.direction_id==direction_id)
         sups = q.order_by(Supplier.name.asc()).limit(50).all()
-    finally:
-        sess.close()
     kb = types.InlineKeyboardMarkup(row_width=2)
     for s in sups:
         kb.add(types.InlineKeyboardButton(s.name, callback_data=mk_cb("r_sup", id=s.id)))
-    kb.add(types.InlineKeyboardButton("— Без поставщика —", callback_data=mk_cb("r_sup", id=0)))
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=mk_cb("r_back")))
+    kb.add(types.InlineKeyboardButton("— Без поставщика —", callback_data=CB_R_SUP_NONE))
+    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=CB_R_BACK))
     send_safe("Шаг 3/8: Выбери поставщика", chat_id, reply_markup=kb)
 
 def ask_periodicity(chat_id):
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
-        types.InlineKeyboardButton("Ежедневно", callback_data=mk_cb("r_per", v="daily")),
-        types.InlineKeyboardButton("По дням недели", callback_data=mk_cb("r_per", v="weekdays")),
-        types.InlineKeyboardButton("Каждые N дней", callback_data=mk_cb("r_per", v="every_n_days")),
+        types.InlineKeyboardButton("Ежедневно", callback_data=CB_R_PER["daily"]),
+        types.InlineKeyboardButton("По дням недели", callback_data=CB_R_PER["weekdays"]),
+        types.InlineKeyboardButton("Каждые N дней", callback_data=CB_R_PER["every_n_days"]),
     )
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=mk_cb("r_back")))
+    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=CB_R_BACK))
     send_safe("Шаг 4/8: Выбери периодичность", chat_id, reply_markup=kb)
 
 def ask_weekdays(chat_id, preselected:str=""):
-    days = [("пн","Пн"),("вт","Вт"),("ср","Ср"),("чт","Чт"),("пт","Пт"),("сб","Сб"),("вс","Вс")]
+    days = WIZ_DAYS
     sel = {x.strip() for x in (preselected or "").split(",") if x.strip()}
     kb = types.InlineKeyboardMarkup(row_width=4)
     for code, label in days:
         mark = "✅" if code in sel else "⬜"
-        kb.add(types.InlineKeyboardButton(f"{mark} {label}", callback_data=mk_cb("r_wd", d=code)))
-    kb.add(types.InlineKeyboardButton("Готово", callback_data=mk_cb("r_wd_done")))
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=mk_cb("r_back")))
+        kb.add(types.InlineKeyboardButton(f"{mark} {label}", callback_data=CB_R_WD[code]))
+    kb.add(types.InlineKeyboardButton("Готово", callback_data=CB_R_WD_DONE))
+    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=CB_R_BACK))
     send_safe("Отметь дни недели (переключатели):", chat_id, reply_markup=kb)
 
 def ask_every_n(chat_id):
@@ -1122,26 +1381,26 @@ def ask_every_n(chat_id):
 def ask_notify_time(chat_id):
     kb = types.InlineKeyboardMarkup()
     kb.add(
-        types.InlineKeyboardButton("Без времени", callback_data=mk_cb("r_time_set", v="none")),
-        types.InlineKeyboardButton("Указать время", callback_data=mk_cb("r_time_set", v="ask")),
+        types.InlineKeyboardButton("Без времени", callback_data=CB_R_TIME_SET["none"]),
+        types.InlineKeyboardButton("Указать время", callback_data=CB_R_TIME_SET["ask"]),
     )
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=mk_cb("r_back")))
+    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=CB_R_BACK))
     send_safe("Шаг 5/8: Время уведомления", chat_id, reply_markup=kb)
 
 def ask_before(chat_id):
     kb = types.InlineKeyboardMarkup(row_width=5)
-    for m in [0,5,10,30,60]:
-        kb.add(types.InlineKeyboardButton(f"{m} мин", callback_data=mk_cb("r_before", v=m)))
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=mk_cb("r_back")))
+    for m, data in CB_R_BEFORE.items():
+        kb.add(types.InlineKeyboardButton(f"{m} мин", callback_data=data))
+    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=CB_R_BACK))
     send_safe("Шаг 6/8: Ранний пинг (за сколько минут)", chat_id, reply_markup=kb)
 
 def ask_auto(chat_id):
     kb = types.InlineKeyboardMarkup()
     kb.add(
-        types.InlineKeyboardButton("Автосоздание: ON", callback_data=mk_cb("r_auto_set", v=1)),
-        types.InlineKeyboardButton("Автосоздание: OFF", callback_data=mk_cb("r_auto_set", v=0)),
+        types.InlineKeyboardButton("Автосоздание: ON", callback_data=CB_R_AUTO_SET[1]),
+        types.InlineKeyboardButton("Автосоздание: OFF", callback_data=CB_R_AUTO_SET[0]),
     )
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=mk_cb("r_back")))
+    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data=CB_R_BACK))
     send_safe("Шаг 7/8: Автосоздание задач", chat_id, reply_markup=kb)
 
 def ask_title(chat_id):
@@ -1166,8 +1425,7 @@ def r_wiz_summary(data:dict)->str:
             f"• Автосоздание: {auto}")
 
 def r_wiz_save(uid, chat_id):
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         data = RULE_WIZ.get(uid, {}).get("data", {})
         r = Rule(
             user_id=uid,
@@ -1185,15 +1443,13 @@ def r_wiz_save(uid, chat_id):
         )
         sess.add(r); sess.commit()
         send_safe("✅ Правило сохранено:\n\n"+rule_brief(r), chat_id)
-    finally:
-        sess.close()
     r_wiz_reset(uid)
 
-@bot.callback_query_handler(func=lambda c: c.data and parse_cb(c.data) and parse_cb(c.data).get("a","").startswith("r_") or c.data in ("noop",))
+@bot.callback_query_handler(func=_is_rule_cb)
 def rules_callbacks(c):
     uid = c.from_user.id
     chat_id = c.message.chat.id
-    data = parse_cb(c.data) if c.data!="noop" else None
+    data = parse_cb(c.data)
     if not data:
         bot.answer_callback_query(c.id); return
     a = data.get("a")
@@ -1215,6 +1471,16 @@ def rules_callbacks(c):
             send_safe("Вернулся в начало.", chat_id); r_wiz_reset(uid)
         bot.answer_callback_query(c.id); return
 
+    if a == "r_page":
+        with db() as sess:
+            text, kb = rules_page(user_rules(sess, uid), int(data.get("p") or 1))
+        bot.answer_callback_query(c.id)
+        try:
+            bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb)
+        except Exception:
+            pass
+        return
+
     # старт создания
     if a == "r_add":
         RULE_WIZ[uid] = {"step":"dir","data":{}}
@@ -1310,8 +1576,7 @@ def rules_callbacks(c):
     # карточка/действия по правилу
     if a == "r_info":
         rid = int(data.get("id"))
-        sess = SessionLocal()
-        try:
+        with db() as sess:
             r = sess.query(Rule).filter(Rule.id==rid, Rule.user_id==uid).first()
             if not r:
                 bot.answer_callback_query(c.id, "Правило не найдено", show_alert=True); return
@@ -1326,44 +1591,33 @@ def rules_callbacks(c):
             )
             kb.row(types.InlineKeyboardButton("🗑 Удалить", callback_data=mk_cb("r_del", id=rid)))
             send_safe(rule_brief(r), chat_id, reply_markup=kb)
-        finally:
-            sess.close()
         bot.answer_callback_query(c.id); return
 
     if a == "r_auto":
         rid = int(data.get("id"))
-        sess = SessionLocal()
-        try:
+        with db() as sess:
             r = sess.query(Rule).filter(Rule.id==rid, Rule.user_id==uid).first()
             if not r: bot.answer_callback_query(c.id, "Не найдено", show_alert=True); return
             r.auto_create = not r.auto_create; sess.commit()
             bot.answer_callback_query(c.id, f"Автосоздание: {'on' if r.auto_create else 'off'}")
-        finally:
-            sess.close()
         return
 
     if a == "r_active":
         rid = int(data.get("id"))
-        sess = SessionLocal()
-        try:
+        with db() as sess:
             r = sess.query(Rule).filter(Rule.id==rid, Rule.user_id==uid).first()
             if not r: bot.answer_callback_query(c.id, "Не найдено", show_alert=True); return
             r.active = not r.active; sess.commit()
             bot.answer_callback_query(c.id, f"{'Включено' if r.active else 'Выключено'}")
-        finally:
-            sess.close()
         return
 
     if a == "r_del":
         rid = int(data.get("id"))
-        sess = SessionLocal()
-        try:
+        with db() as sess:
             r = sess.query(Rule).filter(Rule.id==rid, Rule.user_id==uid).first()
             if not r: bot.answer_callback_query(c.id, "Не найдено", show_alert=True); return
             sess.delete(r); sess.commit()
             bot.answer_callback_query(c.id, "Удалено", show_alert=True)
-        finally:
-            sess.close()
         return
 
     if a == "r_edit":
@@ -1388,8 +1642,7 @@ def rules_text_steps(m):
     # приоритет редактирования существующего правила
     if RULE_EDIT.get(uid):
         rid = RULE_EDIT[uid]["rule_id"]; field = RULE_EDIT[uid]["field"]
-        sess = SessionLocal()
-        try:
+        with db() as sess:
             r = sess.query(Rule).filter(Rule.id==rid, Rule.user_id==uid).first()
             if not r:
                 RULE_EDIT.pop(uid, None)
@@ -1409,8 +1662,6 @@ def rules_text_steps(m):
                         send_safe("Формат времени: ЧЧ:ММ или «none»", uid); return
                 sess.commit()
                 send_safe("✅ Обновил время.\n\n"+rule_brief(r), uid)
-        finally:
-            sess.close()
         RULE_EDIT.pop(uid, None)
         return
 
@@ -1448,27 +1699,32 @@ def make_auto_key(user_id:int, dt:date, title:str, direction_id:Optional[int], s
     raw = f"{user_id}|{dt.isoformat()}|{title}|{direction_id or 0}|{supplier_id or 0}|{task_type}"
     return hashlib.sha1(raw.encode("utf-8")).hexdigest()
 
+WD_IDX = {"пн":0,"вт":1,"ср":2,"чт":3,"пт":4,"сб":5,"вс":6}
+
+@lru_cache(maxsize=4096)
+def _rule_pred(periodicity:str, every_n:Optional[int], weekdays:Optional[str], base:date):
+    # тик правил идёт каждую минуту — разбор периодичности делаем один раз на набор параметров
+    if periodicity == "daily":
+        return lambda target: True
+    if periodicity == "every_n_days":
+        if not every_n or every_n <= 0:
+            return lambda target: False
+        return lambda target: (target - base).days >= 0 and (target - base).days % every_n == 0
+    if periodicity == "weekdays":
+        wanted = frozenset(WD_IDX[x] for x in (x.strip() for x in (weekdays or "").split(",")) if x in WD_IDX)
+        return lambda target: target.weekday() in wanted
+    return lambda target: False
+
 def rule_hits_today(r: Rule, target: date) -> bool:
-    if r.periodicity == "daily":
-        return True
-    if r.periodicity == "every_n_days":
-        base = (r.created_at.date() if r.created_at else date(2025,1,1))
-        delta = (target - base).days
-        return (delta >= 0 and r.every_n and r.every_n > 0 and delta % r.every_n == 0)
-    if r.periodicity == "weekdays":
-        days = {"пн":0,"вт":1,"ср":2,"чт":3,"пт":4,"сб":5,"вс":6}
-        wd_list = [x.strip() for x in (r.weekdays or "").split(",") if x.strip()]
-        wanted = {days.get(x) for x in wd_list if x in days}
-        return target.weekday() in wanted
-    return False
+    base = (r.created_at.date() if r.created_at else date(2025,1,1))
+    return _rule_pred(r.periodicity, r.every_n, r.weekdays, base)(target)
 
 def rule_human(r: Rule) -> str:
     base = "📌" if r.type=="todo" else "📦"
     return f"{base} {r.title or '(без названия)'}"
 
 def job_rules_tick():
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         now = now_local()
         today = now.date()
         rules = sess.query(Rule).filter(Rule.active==True).all()
@@ -1477,7 +1733,7 @@ def job_rules_tick():
             if r.notify_time:
                 nt = datetime.combine(today, r.notify_time)
                 if nt.tzinfo is None:
-                    nt = LOCAL_TZ.localize(nt)
+                    nt = nt.replace(tzinfo=LOCAL_TZ)
                 before = nt - timedelta(minutes=(r.notify_before_min or 0))
                 if before <= now < nt:
                     try:
@@ -1489,7 +1745,7 @@ def job_rules_tick():
             if rule_hits_today(r, today) and r.auto_create:
                 title = r.title or ("Задача по правилу" if r.type=="todo" else "Заказ по правилу")
                 ak = make_auto_key(r.user_id, today, title, r.direction_id, r.supplier_id, r.type)
-                dup = sess.query(Task).filter(Task.user_id==r.user_id, Task.date==today, Task.auto_key==ak).first()
+                dup = sess.query(exists().where(Task.user_id==r.user_id, Task.date==today, Task.auto_key==ak)).scalar()
                 if not dup:
                     t = Task(
                         user_id=r.user_id, date=today, text=title,
@@ -1500,31 +1756,38 @@ def job_rules_tick():
                     )
                     sess.add(t)
         sess.commit()
-    finally:
-        sess.close()
 
 # --------- Schedulers ---------
+DIGEST_WORKERS = int(os.getenv("DIGEST_WORKERS", "8"))  # параллельных отправок дайджеста
+
 def job_daily_digest():
-    sess = SessionLocal()
+    with db() as sess:
+        today = now_local().date(); today_s = dstr(today)
+        uids = select(User.id).where(User.digest_08==True)
+        # повторы раскрываем только тем, у кого есть шаблоны
+        for uid in sess.scalars(select(Task.user_id).where(Task.is_repeating==True, Task.user_id.in_(uids)).distinct()).all():
+            expand_repeats_for_date(sess, uid, today)
+        # все задачи дня одним запросом вместо запроса на каждого пользователя
+        rows = sess.execute(select(*TASK_VIEW_COLS)
+                            .where(Task.date==today, Task.is_repeating==False, Task.user_id.in_(uids))
+                            .order_by(Task.user_id, *TASK_ORDER)).all()
+    # рассылка уже без сессии: долгий цикл send не держит соединение и транзакцию
+    # строки упорядочены по user_id в SQL — группируем потоком, без промежуточного dict
+    prepared = [(uid, f"📅 План на {today_s}\n\n" + format_grouped(list(grp), header_date=today_s))
+                for uid, grp in groupby(rows, key=lambda t: t.user_id)]
+    # отправки параллельно (сеть ~100 мс на сообщение), темп держит _send_slot в send_safe
+    with ThreadPoolExecutor(max_workers=DIGEST_WORKERS, thread_name_prefix="digest") as ex:
+        list(ex.map(_send_digest, prepared))
+
+def _send_digest(item):
+    uid, text = item
     try:
-        today = now_local().date()
-        users = sess.query(User).all()
-        for u in users:
-            if not u.digest_08: continue
-            expand_repeats_for_date(sess, u.id, today)
-            tasks = tasks_for_date(sess, u.id, today)
-            if not tasks: continue
-            text = f"📅 План на {dstr(today)}\n\n" + format_grouped(tasks, header_date=dstr(today))
-            try:
-                send_safe(text, u.id)
-            except Exception as e:
-                log.error("digest send error: %s", e)
-    finally:
-        sess.close()
+        send_safe(text, uid)
+    except Exception as e:
+        log.error("digest send error: %s", e)
 
 def job_check_reminders():
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         now = now_local()
         due = (sess.query(Reminder)
                .filter(Reminder.fired==False,
@@ -1532,7 +1795,7 @@ def job_check_reminders():
                            and_(Reminder.date==now.date(), Reminder.time<=now.time())))
                .all())
         for r in due:
-            t = sess.query(Task).filter(Task.id==r.task_id, Task.user_id==r.user_id).first()
+            t = own_task(sess, r.task_id, r.user_id)
             if not t:
                 r.fired = True
                 continue
@@ -1542,8 +1805,6 @@ def job_check_reminders():
                 log.error("reminder send error: %s", e)
             r.fired = True
         sess.commit()
-    finally:
-        sess.close()
 
 def job_orchestrator_minutely():
     global LAST_TICK
@@ -1551,34 +1812,62 @@ def job_orchestrator_minutely():
     job_check_reminders()
     job_rules_tick()
 
-def scheduler_loop():
-    schedule.clear()
-    schedule.every().day.at("08:00").do(job_daily_digest)
-    schedule.every(1).minutes.do(job_orchestrator_minutely)
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+# BackgroundScheduler спит до ближайшего срабатывания, а не просыпается каждую секунду
+# coalesce: пропущенные запуски (долгий тик, пауза процесса) схлопываются в один;
+# max_instances=1 — минутный тик не наслаивается сам на себя
+scheduler = BackgroundScheduler(timezone=LOCAL_TZ,
+                                job_defaults=dict(coalesce=True, max_instances=1, misfire_grace_time=60))
+scheduler.add_job(job_daily_digest, CronTrigger(hour=8, minute=0, timezone=LOCAL_TZ), id="daily_digest", replace_existing=True)
+scheduler.add_job(job_orchestrator_minutely, "interval", minutes=1, id="minutely", replace_existing=True)
 
 # --------- /health ---------
 @bot.message_handler(commands=["health"])
 def cmd_health(m):
     if ADMIN_IDS and m.from_user and m.from_user.id not in ADMIN_IDS:
         return
-    sess = SessionLocal()
-    try:
+    with db() as sess:
         rc = sess.query(Rule).filter(Rule.active==True).count()
-    finally:
-        sess.close()
     lt = LAST_TICK.isoformat() if LAST_TICK else "—"
     send_safe(f"✅ OK\nLast tick: {lt}\nActive rules: {rc}\nTZ: {TZ_NAME}", m.chat.id)
 
+# --------- WEBHOOK (Flask, gunicorn -c gunicorn.conf.py tasks_bot:app) ---------
+app = Flask(__name__)
+
+@app.get("/healthz")
+def healthz():
+    return "ok"
+
+@app.post(f"/{API_TOKEN}")
+def tg_webhook():
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        abort(403)
+    # тело парсим orjson из байтов; de_json принимает готовый dict
+    bot.process_new_updates([types.Update.de_json(orjson.loads(request.get_data()))])
+    return ""
+
+def start_scheduler():
+    """Планировщик — один на процесс: для gunicorn его запускает post_worker_init."""
+    if not scheduler.running:
+        scheduler.start()
+
+def setup_webhook():
+    """Webhook при старте воркера (WEBHOOK_BASE задан): апдейты приходят push'ем, без getUpdates."""
+    if not WEBHOOK_BASE: return
+    try:
+        bot.set_webhook(url=f"{WEBHOOK_BASE.rstrip('/')}/{API_TOKEN}", secret_token=WEBHOOK_SECRET or None,
+                        allowed_updates=["message","callback_query"])
+        log.info("Webhook set: %s/<token>", WEBHOOK_BASE.rstrip("/"))
+    except Exception as e:
+        log.error("set_webhook error: %s", e)
+
 # --------- START (polling) ---------
 if __name__ == "__main__":
     try:
         bot.remove_webhook()
     except Exception:
         pass
-    threading.Thread(target=scheduler_loop, daemon=True).start()
+    start_scheduler()
     log.info("Starting polling…")
     while True:
         try:
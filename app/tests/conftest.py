@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""Общая подготовка: импорт tasks_bot без БД и Telegram.
+
+RUN_DDL не задан — схему не трогаем; engine ленивый, соединение не открывается.
+Запуск из app/: pip install -r requirements-dev.txt && python -m pytest -q tests
+"""
+import os, sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), os.path.dirname(os.path.dirname(HERE))]  # app/ и корень (org_ext, ops_ext)
+os.environ.setdefault("TELEGRAM_TOKEN", "1:test")
+os.environ.setdefault("DATABASE_URL", "postgresql+psycopg2://u:p@127.0.0.1:1/test")
+os.environ.setdefault("CALLBACK_SECRET", "test-secret")
+os.environ.pop("RUN_DDL", None)
+os.environ.pop("OPENAI_API_KEY", None)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Кодек callback_data «sig|code|v1|v2»: круговой разбор и отказ на подделках."""
+import json, hashlib
+
+import pytest
+
+import tasks_bot
+from tasks_bot import mk_cb, parse_cb, CB_FIELDS, CB_CODES, _NOOP
+
+def test_roundtrip_every_action():
+    for action, fields in CB_FIELDS.items():
+        vals = {f: f"{i + 1}" for i, f in enumerate(fields)}
+        data = mk_cb(action, **vals)
+        assert len(data.encode("utf-8")) <= 64
+        assert parse_cb(data) == {"a": action, **vals}
+
+def test_wire_format():
+    data = mk_cb("mv", id=17, to="tomorrow")
+    sig, code, *vals = data.split("|")
+    assert code == CB_CODES["mv"] and vals == ["17", "tomorrow"]
+    assert len(sig) == 6  # blake2s, digest_size=3
+
+def test_empty_values_are_omitted():
+    assert parse_cb(mk_cb("page", p=2)) == {"a": "page", "p": "2"}
+
+@pytest.mark.parametrize("data", [None, "", "noop", _NOOP, "abc", "a|b", "1234567"])
+def test_short_or_unsigned_rejected(data):
+    assert parse_cb(data) is None
+
+def test_forged_signature_rejected():
+    sig, rest = mk_cb("del", id=5).split("|", 1)
+    forged = ("0" if sig[0] != "0" else "1") + sig[1:]
+    assert parse_cb(f"{forged}|{rest}") is None
+
+def test_tampered_value_rejected():
+    sig, _ = mk_cb("del", id=5).split("|", 1)
+    assert parse_cb(f"{sig}|{CB_CODES['del']}|6") is None
+
+def test_wrong_field_count_rejected():
+    s = f"{CB_CODES['mv']}|5"  # у mv два поля
+    assert parse_cb(f"{tasks_bot._cb_sign(s.encode())}|{s}") is None
+
+def test_unknown_and_full_name_codes_rejected():
+    for s in ("zz|5", "open|5"):  # полные имена действий больше не принимаются
+        assert parse_cb(f"{tasks_bot._cb_sign(s.encode())}|{s}") is None
+
+def test_legacy_json_sha1_button_rejected():
+    payload = json.dumps({"a": "open", "id": 5})
+    sig = hashlib.sha1(tasks_bot._CB_KEY + payload.encode()).hexdigest()[:10]
+    assert parse_cb(f"{sig}|{payload}") is None
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""grouped_lines/format_grouped на строках в TASK_ORDER совпадают с исходным format_grouped."""
+from datetime import date, time as dtime
+from types import SimpleNamespace
+
+import pytest
+
+from formatters import format_grouped, grouped_lines, dstr, tstr
+from tasks_bot import task_order_key  # Python-зеркало TASK_ORDER
+
+def _baseline(tasks, header_date=None):
+    # исходная реализация из tasks_bot — эталон вывода
+    if not tasks: return "Задач нет."
+    wd = ["Понедельник","Вторник","Среда","Четверг","Пятница","Суббота","Воскресенье"]
+    out = []
+    if header_date:
+        out.append(f"• {wd[tasks[0].date.weekday()]} — {header_date}\n")
+    cur_cat = cur_sub = None
+    for t in sorted(tasks, key=lambda x: (x.category or "", x.subcategory or "", x.deadline or dtime.min, x.text)):
+        icon = "✅" if t.status=="выполнено" else "⬜"
+        if t.category != cur_cat:
+            out.append(f"📂 <b>{t.category or '—'}</b>"); cur_cat = t.category; cur_sub = None
+        if t.subcategory != cur_sub:
+            out.append(f"  └ <b>{t.subcategory or '—'}</b>"); cur_sub = t.subcategory
+        pr_emoji = {"high":"🔴","medium":"🟡","low":"🟢","future":"⏳"}.get(t.priority or "medium","🟡")
+        line = f"    └ {icon} {pr_emoji} {t.text}"
+        if t.deadline: line += f"  <i>(до {tstr(t.deadline)})</i>"
+        if t.assignee_id and t.assignee_id!=t.user_id: line += f"  [делегировано: {t.assignee_id}]"
+        out.append(line)
+    return "\n".join(out)
+
+def _t(cat, sub, text, deadline=None, status="", priority="medium", assignee_id=None):
+    return SimpleNamespace(category=cat, subcategory=sub, text=text, deadline=deadline, status=status,
+                           priority=priority, assignee_id=assignee_id, user_id=1, date=date(2025, 1, 1))
+
+CASES = {
+    "plain": [_t("Кофейня", "Центр", "a"), _t("Кофейня", "Центр", "b"), _t("Кофейня", "Полет", "c")],
+    "two_categories": [_t("Кофейня", "Центр", "a"), _t("Табачка", "Центр", "b")],
+    "null_subcategory": [_t("Личное", None, "a"), _t("Личное", None, "b"), _t("Работа", None, "c")],
+    "null_then_sub": [_t("Личное", None, "a"), _t("Личное", "Дом", "b")],
+    "null_category_first": [_t(None, None, "a"), _t("Личное", "Дом", "b")],
+    "details": [_t("Кофейня", "Центр", "a", deadline=dtime(10, 0), status="выполнено", priority="high"),
+                _t("Кофейня", "Центр", "b", priority=None, assignee_id=7)],
+}
+
+@pytest.mark.parametrize("name", CASES)
+@pytest.mark.parametrize("header", [None, "01.01.2025"])
+def test_matches_baseline(name, header):
+    # строки приходят в порядке TASK_ORDER, как из SQL
+    rows = sorted(CASES[name], key=task_order_key)
+    assert format_grouped(rows, header) == _baseline(rows, header)
+
+def test_no_header_for_null_subcategory():
+    lines = list(grouped_lines(sorted(CASES["null_subcategory"], key=task_order_key)))
+    assert "  └ <b>—</b>" not in lines
+    assert lines[0] == "📂 <b>Личное</b>"
+
+def test_empty():
+    assert format_grouped([]) == "Задач нет."
+
+def test_date_helpers():
+    assert dstr(date(2025, 3, 7)) == "07.03.2025"
+    assert tstr(None) == "—" and tstr(dtime(9, 5)) == "09:05"
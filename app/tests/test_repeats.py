@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""_parse_rule и rule_hits_date: правила повторов шаблонов."""
+from datetime import date, datetime, time as dtime
+
+import pytest
+
+from tasks_bot import _parse_rule, rule_hits_date
+
+MON = date(2025, 1, 6)  # понедельник
+DL = dtime(9, 0)
+
+@pytest.mark.parametrize("text, parsed", [
+    ("каждые 3 дня", ("every_n", 3)),
+    ("Каждые дни", ("every_n", 1)),
+    ("каждый понедельник", ("weekday", 0, None)),
+    ("каждый пт 18:30", ("weekday", 4, dtime(18, 30))),
+    ("каждый день", ("weekday", None, None)),
+    ("по пн, ср", ("weekdays", frozenset({0, 2}))),
+    ("по выходным", ("weekdays", frozenset())),
+    ("раз в месяц", ("none",)),
+])
+def test_parse_rule(text, parsed):
+    assert _parse_rule(text) == parsed
+
+def test_empty_rule():
+    assert rule_hits_date("", None, MON, DL) is None
+
+def test_every_n_from_created_at():
+    created = datetime(2025, 1, 1, 12, 0)
+    assert rule_hits_date("каждые 2 дня", created, date(2025, 1, 1), DL) == DL
+    assert rule_hits_date("каждые 2 дня", created, date(2025, 1, 2), DL) is None
+    assert rule_hits_date("каждые 2 дня", created, date(2025, 1, 5), DL) == DL
+    assert rule_hits_date("каждые 2 дня", created, date(2024, 12, 30), DL) is None  # до создания
+
+def test_every_n_without_created_at_uses_base_date():
+    assert rule_hits_date("каждые 5 дней", None, date(2025, 1, 6), DL) == DL
+
+def test_weekday_with_and_without_time():
+    assert rule_hits_date("каждый понедельник", None, MON, DL) == DL
+    assert rule_hits_date("каждый понедельник 07:15", None, MON, DL) == dtime(7, 15)
+    assert rule_hits_date("каждый вторник", None, MON, DL) is None
+    assert rule_hits_date("каждый день", None, MON, DL) is None
+
+def test_weekdays_list():
+    assert rule_hits_date("по пн ср пт", None, MON, DL) == DL
+    assert rule_hits_date("по вт чт", None, MON, None) is None
+
+def test_unknown_rule():
+    assert rule_hits_date("ежемесячно", None, MON, DL) is None
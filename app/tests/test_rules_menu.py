@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""«⚙️ Правила» из главного меню доходит до rules_menu и показывает список одним сообщением.
+
+БД и Telegram не нужны (см. conftest): запрос правил и отправка подменяются.
+"""
+from types import SimpleNamespace
+
+from telebot import types
+import tasks_bot
+
+def _update(text, chat_id=42):
+    return types.Update.de_json({
+        "update_id": 1,
+        "message": {"message_id": 1, "date": 0, "text": text,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "t"}},
+    })
+
+def _rule(rid, title):
+    return SimpleNamespace(id=rid, title=title, type="todo", periodicity="daily", weekdays=None, every_n=None,
+                           notify_time=None, notify_before_min=0, auto_create=True, active=True,
+                           direction=None, supplier=None)
+
+def test_rules_menu_shows_rules(monkeypatch):
+    sent = []
+    monkeypatch.setattr(tasks_bot.bot, "threaded", False)  # обработчик — синхронно в этом потоке
+    monkeypatch.setattr(tasks_bot, "user_rules", lambda sess, uid: [_rule(2, "Заказ"), _rule(1, "Сверка")])
+    monkeypatch.setattr(tasks_bot.bot, "send_message",
+                        lambda chat_id, text, **kw: sent.append((chat_id, text, kw)))
+
+    tasks_bot.bot.process_new_updates([_update("⚙️ Правила")])
+
+    assert len(sent) == 1
+    chat_id, text, kw = sent[0]
+    assert chat_id == 42
+    assert text.startswith("⚙️ Твои правила (1/1):")
+    assert "Заказ" in text and "Сверка" in text
+    assert isinstance(kw["reply_markup"], types.InlineKeyboardMarkup)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""cut_lines (обрезка HTML по строке) и повторы send_safe."""
+import pytest
+from telebot import apihelper
+
+import tasks_bot
+from tasks_bot import cut_lines, TG_MAX_TEXT
+
+def test_short_text_untouched():
+    assert cut_lines("a\nb") == "a\nb"
+    s = "x" * TG_MAX_TEXT
+    assert cut_lines(s) == s
+
+def test_cut_on_line_boundary_keeps_tags_balanced():
+    s = "<b>строка</b>\n" * 1000
+    r = cut_lines(s)
+    assert len(r) <= TG_MAX_TEXT
+    assert r.endswith("\n…")
+    body = r[:-2]
+    assert body.count("<b>") == body.count("</b>")
+    assert all(line == "<b>строка</b>" for line in body.split("\n"))
+
+def test_one_long_line_is_hard_cut():
+    r = cut_lines("y" * 5000)
+    assert len(r) == TG_MAX_TEXT and r.endswith("\n…")
+
+def test_custom_limit():
+    r = cut_lines("aaaa\nbbbb\ncccc", limit=11)
+    assert r == "aaaa\n…"
+    assert len(cut_lines("z\n" * 3000, 4000)) <= 4000
+
+class _Resp:
+    status_code = 0
+
+def _api_error(code, **params):
+    return apihelper.ApiTelegramException("sendMessage", _Resp(),
+                                          {"error_code": code, "description": "x", "parameters": params})
+
+@pytest.fixture
+def nosleep(monkeypatch):
+    slept = []
+    monkeypatch.setattr(tasks_bot.time, "sleep", slept.append)
+    monkeypatch.setattr(tasks_bot, "_send_slot", lambda: None)
+    return slept
+
+def _sender(monkeypatch, errors):
+    calls = []
+    def send(chat_id, text, **kw):
+        calls.append(text)
+        if errors: raise errors.pop(0)
+        return "ok"
+    monkeypatch.setattr(tasks_bot.bot, "send_message", send)
+    return calls
+
+def test_4xx_raises_without_retry(monkeypatch, nosleep):
+    calls = _sender(monkeypatch, [_api_error(400)])
+    with pytest.raises(apihelper.ApiTelegramException):
+        tasks_bot.send_safe("hi", 1)
+    assert len(calls) == 1 and nosleep == []
+
+def test_429_sleeps_retry_after(monkeypatch, nosleep):
+    calls = _sender(monkeypatch, [_api_error(429, retry_after=3)])
+    assert tasks_bot.send_safe("hi", 1) == "ok"
+    assert len(calls) == 2 and nosleep == [pytest.approx(3.1)]
+
+def test_5xx_retried_then_fallback(monkeypatch, nosleep):
+    calls = _sender(monkeypatch, [_api_error(502) for _ in range(6)])
+    assert tasks_bot.send_safe("<b>a</b>\n" * 600, 1) == "ok"
+    assert len(calls) == 7
+    assert len(calls[-1]) <= 4000
@@ -23,7 +23,7 @@ from telebot.types import (
 )
 
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Numeric
+    create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Numeric, exists, func
 )
 from sqlalchemy.orm import declarative_base, Session, sessionmaker, relationship
 
@@ -135,8 +135,7 @@ def gen_transfer_number(session: Session) -> str:
     tail = str(uuid.uuid4())[:6].upper()
     num = base + tail
     # на всякий случай проверим
-    exists = session.query(OpsTransfer).filter_by(number=num).first()
-    if exists:
+    if session.query(exists().where(OpsTransfer.number==num)).scalar():
         return gen_transfer_number(session)
     return num
 
@@ -163,6 +162,8 @@ def kb_ops_root():
     )
     return kb
 
+KB_OPS_ROOT = kb_ops_root()  # статичное меню — собираем один раз
+
 def kb_yesno(cb_yes: str, cb_no: str):
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("Да", callback_data=cb_yes),
@@ -224,7 +225,7 @@ class OpsExt:
 
         @bot.message_handler(commands=["ops"])
         def cmd_ops(m: Message):
-            bot.send_message(m.chat.id, "Контур перемещений и приёмки:", reply_markup=kb_ops_root())
+            bot.send_message(m.chat.id, "Контур перемещений и приёмки:", reply_markup=KB_OPS_ROOT)
 
         # ---- Отправитель (Откуда): создать перемещение
         @bot.callback_query_handler(func=lambda c: c.data == "ops_tr_new")
@@ -319,14 +320,13 @@ class OpsExt:
                     created_at=now_utc(), updated_at=now_utc()
                 )
                 s.add(tr); s.flush()
-                for it in sess.get("items", []):
-                    s.add(OpsTransferItem(transfer_id=tr.id, name=it["name"], qty_planned=it["qty"]))
+                s.add_all([OpsTransferItem(transfer_id=tr.id, name=it["name"], qty_planned=it["qty"])
+                           for it in sess.get("items", [])])
                 # фото уже собрали в evidence_temp
-                for ev in sess.get("evidence_temp", []):
-                    s.add(OpsTransferEvidence(
-                        transfer_id=tr.id, kind="photo", payload=ev["file_id"],
-                        file_unique_id=ev["uid"], author_tg=m.from_user.id
-                    ))
+                s.add_all([OpsTransferEvidence(
+                    transfer_id=tr.id, kind="photo", payload=ev["file_id"],
+                    file_unique_id=ev["uid"], author_tg=m.from_user.id
+                ) for ev in sess.get("evidence_temp", [])])
                 s.commit()
 
                 # уведомление в "Куда" (в чат точки, если задан) + авто-задача (в виде входящего списка)
@@ -341,7 +341,7 @@ class OpsExt:
                 for admin_id in (ADMIN_IDS or {m.chat.id}):
                     bot.send_message(admin_id, f"🧾 Накладная перемещения #{tr.number}\n{tr.from_location} → {tr.to_location}\nПозиций: {len(sess['items'])}")
 
-            SESS[m.from_user.id].clear()
+            SESS.pop(m.from_user.id, None)
 
         @bot.message_handler(content_types=['photo'])
         def tr_collect_photo(m: Message):
@@ -413,7 +413,7 @@ class OpsExt:
             # уведомим старшего (если SENIOR_IDS есть)
             for sid in (SENIOR_IDS or {m.chat.id}):
                 self.bot.send_message(sid, f"🧐 Проверка перемещения #{tr.number} (без расхождений).", reply_markup=kb_review_senior(tr_id))
-            SESS[m.from_user.id].clear()
+            SESS.pop(m.from_user.id, None)
 
         # Есть расхождения -> выбираем строки
         @bot.callback_query_handler(func=lambda c: c.data.startswith("ops_tr_diff:"))
@@ -492,7 +492,7 @@ class OpsExt:
             self.bot.send_message(c.message.chat.id, f"Перемещение #{tr.number} с расхождениями отправлено на проверку старшему.")
             for sid in (SENIOR_IDS or {c.message.chat.id}):
                 self.bot.send_message(sid, f"🧐 Проверка перемещения #{tr.number} (с расхождениями).", reply_markup=kb_review_senior(tr_id))
-            SESS[c.from_user.id].clear()
+            SESS.pop(c.from_user.id, None)
 
         # ---- Ревью Старшего
         @bot.callback_query_handler(func=lambda c: c.data.startswith("ops_tr_senior_accept:"))
@@ -580,12 +580,12 @@ class OpsExt:
     def _send_transfer_card(self, chat_id: int, tr: OpsTransfer):
         with self.SessionLocal() as s:
             items = s.query(OpsTransferItem).filter_by(transfer_id=tr.id).all()
-            diffs = s.query(OpsTransferDiscrepancy).filter_by(transfer_id=tr.id).all()
+            n_diffs = s.query(func.count(OpsTransferDiscrepancy.id)).filter_by(transfer_id=tr.id).scalar()
         title = f"#{tr.number} | {tr.from_location} → {tr.to_location}\nСтатус: {tr.status}"
         lines = "\n".join([f"• {it.name} — план {it.qty_planned}" for it in items][:20])
         if len(items) > 20:
             lines += f"\n… и ещё {len(items)-20}"
-        diffbadge = (f"\nРасхождения: {len(diffs)}" if diffs else "")
+        diffbadge = (f"\nРасхождения: {n_diffs}" if n_diffs else "")
         txt = f"📦 Перемещение {title}\n{lines}{diffbadge}"
         kb = InlineKeyboardMarkup(row_width=2)
         if tr.status in ("in_transit","needs_fix"):
@@ -12,6 +12,7 @@ OrgExt — расширение для TasksBot:
 """
 
 import os, uuid
+from time import monotonic
 from math import radians, sin, cos, asin, sqrt
 from datetime import datetime, timedelta, time
 from collections import defaultdict
@@ -24,7 +25,7 @@ from telebot.types import (
 )
 
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Numeric, Time, func
+    create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Numeric, Time, Index, exists, func
 )
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
 
@@ -35,6 +36,7 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///org_ext.db")
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}  # можно пусто на MVP
 GEODIST_RADIUS_DEFAULT_M = int(os.getenv("GEOFENCE_M", "150"))
 ANTI_DUPLICATE_DAYS = int(os.getenv("PHOTO_DEDUP_DAYS", "14"))
+SETTINGS_TTL_SEC = float(os.getenv("ORG_SETTINGS_TTL", "30"))
 
 # -----------------------
 # БД
@@ -105,6 +107,8 @@ class OrgCheckin(Base):
     at = Column(DateTime, default=datetime.utcnow)
     lateness_min = Column(Integer, default=0)
     is_on_time = Column(Boolean, default=False)
+    # антидубль фото: photo_unique_id + окно по времени
+    __table_args__ = (Index("ix_org_checkins_photo_at", "photo_unique_id", "at"),)
 
 class OrgPenalty(Base):
     __tablename__ = "org_penalties"
@@ -114,6 +118,8 @@ class OrgPenalty(Base):
     amount_rub = Column(Integer, nullable=False)
     reason = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # суммы за месяц: user_tg + created_at >= month_start
+    __table_args__ = (Index("ix_org_penalties_user_created", "user_tg", "created_at"),)
 
 class OrgRating(Base):
     __tablename__ = "org_rating"
@@ -122,6 +128,7 @@ class OrgRating(Base):
     delta_points = Column(Integer, nullable=False)
     reason = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index("ix_org_rating_user_created", "user_tg", "created_at"),)
 
 class OrgReportTemplate(Base):
     __tablename__ = "org_report_templates"
@@ -354,6 +361,11 @@ def kb_admin_menu():
     )
     return kb
 
+# статичные меню не зависят от пользователя — собираем один раз
+KB_MAIN = kb_main()
+KB_USER_MENU = kb_user_menu()
+KB_ADMIN_MENU = kb_admin_menu()
+
 def kb_locations(session: Session, direction: str):
     kb = InlineKeyboardMarkup(row_width=2)
     locs = session.query(OrgLocation).filter_by(direction=direction).order_by(OrgLocation.title.asc()).all()
@@ -369,9 +381,14 @@ class OrgExt:
         self.bot = bot
         self.engine = engine or create_engine(DATABASE_URL, pool_pre_ping=True)
         self.SessionLocal = SessionLocal or sessionmaker(bind=self.engine, expire_on_commit=False)
+        self._settings_cache = None  # (monotonic ts, dict) — настройки меняет только админ
 
     def init_db(self):
         Base.metadata.create_all(self.engine)
+        # create_all не добавляет индексы в уже существующие таблицы
+        for model in (OrgCheckin, OrgPenalty, OrgRating):
+            for ix in model.__table__.indexes:
+                ix.create(self.engine, checkfirst=True)
         with self.SessionLocal() as s:
             # settings
             for k, v in DEFAULT_SETTINGS.items():
@@ -418,16 +435,16 @@ class OrgExt:
         def start(m: Message):
             with self.SessionLocal() as s:
                 self.ensure_user(s, m.from_user)
-            bot.send_message(m.chat.id, "Выберите направление:", reply_markup=kb_main())
+            bot.send_message(m.chat.id, "Выберите направление:", reply_markup=KB_MAIN)
 
         @bot.callback_query_handler(func=lambda c: c.data.startswith("org_dir:"))
         def choose_dir(c):
             direction = c.data.split(":")[1]
             SESS[c.from_user.id]["direction"] = direction
             bot.answer_callback_query(c.id)
-            bot.send_message(c.message.chat.id, f"Направление: {'Кофейня' if direction=='coffee' else 'Табачка'}", reply_markup=kb_user_menu())
+            bot.send_message(c.message.chat.id, f"Направление: {'Кофейня' if direction=='coffee' else 'Табачка'}", reply_markup=KB_USER_MENU)
             if is_admin(c.from_user.id):
-                bot.send_message(c.message.chat.id, "Админ-панель:", reply_markup=kb_admin_menu())
+                bot.send_message(c.message.chat.id, "Админ-панель:", reply_markup=KB_ADMIN_MENU)
 
         # ----------- Приглашения / роли (админ) ----------
         @bot.callback_query_handler(func=lambda c: c.data=="org_admin_invites")
@@ -500,7 +517,7 @@ class OrgExt:
                 s.add(inv); s.commit()
             bot.answer_callback_query(c.id)
             bot.send_message(c.message.chat.id, f"Код приглашения: `{code}`\nДействует до {expires:%d.%m %H:%M}\nПусть пользователь отправит команду: `/join {code}`", parse_mode="Markdown")
-            SESS[c.from_user.id].clear()
+            SESS.pop(c.from_user.id, None)
 
         @bot.message_handler(commands=["join"])
         def cmd_join(m: Message):
@@ -550,8 +567,9 @@ class OrgExt:
                 if not row: row = OrgSetting(key=key, value=val)
                 else: row.value = val; row.updated_at = now_utc()
                 s.add(row); s.commit()
+            self._settings_cache = None
             bot.reply_to(m, f"Сохранено: {key} = {val}")
-            SESS[m.from_user.id].clear()
+            SESS.pop(m.from_user.id, None)
 
         # ----------- Локации (админ) ----------
         @bot.callback_query_handler(func=lambda c: c.data=="org_admin_locations")
@@ -567,7 +585,7 @@ class OrgExt:
         @bot.callback_query_handler(func=lambda c: c.data in ("org_checkin","org_checkout"))
         def on_check(c):
             stage = "checkin" if c.data=="org_checkin" else "checkout"
-            direction = SESS[c.from_user.id].get("direction") or "tobacco"
+            direction = SESS.get(c.from_user.id, {}).get("direction") or "tobacco"
             SESS[c.from_user.id] = {"stage": f"geo_{stage}", "direction": direction}
             with self.SessionLocal() as s:
                 kb = kb_locations(s, direction)
@@ -611,9 +629,10 @@ class OrgExt:
             stage = "checkin" if "checkin" in sess["stage"] else "checkout"
             ph = m.photo[-1]
             with self.SessionLocal() as s:
+                now = now_utc()  # один момент времени на весь чек-ин
                 # анти-дубль фото за N дней
-                since = now_utc() - timedelta(days=ANTI_DUPLICATE_DAYS)
-                dup = s.query(OrgCheckin).filter(OrgCheckin.photo_unique_id==ph.file_unique_id, OrgCheckin.at>=since).first()
+                since = now - timedelta(days=ANTI_DUPLICATE_DAYS)
+                dup = s.query(exists().where(OrgCheckin.photo_unique_id==ph.file_unique_id, OrgCheckin.at>=since)).scalar()
                 if dup:
                     self.bot.reply_to(m, "Похоже, это фото уже использовалось ранее. Пришлите свежее.")
                     return
@@ -623,9 +642,9 @@ class OrgExt:
                     loc = s.query(OrgLocation).filter_by(title=sess["location"], direction=sess["direction"]).first()
                     open_dt = datetime.combine(datetime.now().date(), loc.open_time)
                     conf = self.get_settings(s)
-                    late = max(0, int((now_utc() - open_dt).total_seconds() // 60))
+                    late = max(0, int((now - open_dt).total_seconds() // 60))
                     grace = int(conf.get("checkin_after_open_grace_min", "60"))
-                    if now_utc() > open_dt:
+                    if now > open_dt:
                         lateness_min = late
                         is_on_time = (late == 0)
                         if late > 0:
@@ -642,16 +661,16 @@ class OrgExt:
                     lon=m.location.longitude if hasattr(m, "location") else None,
                     dist_m=sess.get("dist_m",0),
                     photo_file_id=ph.file_id, photo_unique_id=ph.file_unique_id,
-                    at=now_utc(), lateness_min=lateness_min, is_on_time=is_on_time
+                    at=now, lateness_min=lateness_min, is_on_time=is_on_time
                 ))
                 s.commit()
             self.bot.reply_to(m, ("Чек-ин выполнен ✅ Хорошей смены!" if stage=="checkin" else "Чек-аут выполнен ✅ Спасибо!"))
-            SESS[m.from_user.id].clear()
+            SESS.pop(m.from_user.id, None)
 
         # ----------- ОТЧЕТНОСТЬ -----------
         @bot.callback_query_handler(func=lambda c: c.data=="org_reports")
         def reports_menu(c):
-            direction = SESS[c.from_user.id].get("direction") or "tobacco"
+            direction = SESS.get(c.from_user.id, {}).get("direction") or "tobacco"
             with self.SessionLocal() as s:
                 kb = kb_locations(s, direction)
             bot.answer_callback_query(c.id)
@@ -665,7 +684,7 @@ class OrgExt:
         @bot.message_handler(commands=["report"])
         def cmd_report(m: Message):
             # быстрый вход: /report
-            direction = SESS[m.from_user.id].get("direction") or "tobacco"
+            direction = SESS.get(m.from_user.id, {}).get("direction") or "tobacco"
             with self.SessionLocal() as s:
                 kb = kb_locations(s, direction)
             bot.send_message(m.chat.id, "Выбери точку для отчёта:", reply_markup=kb)
@@ -678,7 +697,7 @@ class OrgExt:
         # Упрощённо: /rtoday — показать актуальные шаблоны по выбранному направлению/локации на сегодня
         @bot.message_handler(commands=["rtoday"])
         def cmd_rtoday(m: Message):
-            direction = SESS[m.from_user.id].get("direction") or "tobacco"
+            direction = SESS.get(m.from_user.id, {}).get("direction") or "tobacco"
             with self.SessionLocal() as s:
                 kb = kb_locations(s, direction)
             bot.send_message(m.chat.id, "Выбери точку:", reply_markup=kb)
@@ -687,7 +706,7 @@ class OrgExt:
         @bot.callback_query_handler(func=lambda c: SESS.get(c.from_user.id,{}).get("stage")=="rtoday_loc" and c.data.startswith("org_loc:"))
         def rtoday_loc(c):
             loc = c.data.split(":")[1]
-            direction = SESS[c.from_user.id].get("direction") or "tobacco"
+            direction = SESS.get(c.from_user.id, {}).get("direction") or "tobacco"
             with self.SessionLocal() as s:
                 today = datetime.now().weekday()
                 q = s.query(OrgReportTemplate).filter_by(direction=direction, location=loc, active=True)
@@ -695,7 +714,7 @@ class OrgExt:
                     tmpls = q.filter((OrgReportTemplate.dow==today) | (OrgReportTemplate.dow==None)).order_by(OrgReportTemplate.order_num).all()
                 else:
                     tmpls = q.order_by(OrgReportTemplate.order_num).all()
-            SESS[c.from_user.id].clear()
+            SESS.pop(c.from_user.id, None)
             if not tmpls:
                 bot.answer_callback_query(c.id)
                 bot.send_message(c.message.chat.id, "На сегодня нет чек-листов.")
@@ -747,8 +766,8 @@ class OrgExt:
             # анти-дубль фото
             with self.SessionLocal() as s:
                 since = now_utc() - timedelta(days=ANTI_DUPLICATE_DAYS)
-                dup = s.query(OrgReportSubmission).join(OrgReportItemSubmission, OrgReportItemSubmission.submission_id==OrgReportSubmission.id)\
-                      .filter(OrgReportItemSubmission.payload==ph.file_id, OrgReportSubmission.submitted_at>=since).first()
+                dup = s.query(exists().where(OrgReportItemSubmission.submission_id==OrgReportSubmission.id,
+                                             OrgReportItemSubmission.payload==ph.file_id, OrgReportSubmission.submitted_at>=since)).scalar()
                 if dup:
                     self.bot.reply_to(m, "Это фото уже использовалось ранее. Пришлите новое.")
                     return
@@ -788,36 +807,38 @@ class OrgExt:
                 items = s.query(OrgReportItem).filter_by(template_id=tmpl_id).all()
                 sub = OrgReportSubmission(user_tg=c.from_user.id, direction=tmpl.direction, location=tmpl.location, template_id=tmpl_id, submitted_at=now_utc())
                 s.add(sub); s.flush()
-                missed = []
+                conf = self.get_settings(s)  # один запрос на весь отчёт, а не на каждый пункт
+                missed = []; rows = []  # строки отчёта копим и добавляем одним add_all
                 for it in items:
                     if it.id in answers:
                         kind, payload = answers[it.id]
                         ok = True if (kind!="checkbox" or payload=="ok") else True
-                        s.add(OrgReportItemSubmission(submission_id=sub.id, item_id=it.id, ok=ok, payload=payload))
+                        rows.append(OrgReportItemSubmission(submission_id=sub.id, item_id=it.id, ok=ok, payload=payload))
                         if ok and it.required and it.kind!="checkbox":
                             # плюс очки
-                            pts = int(self.get_settings(s).get("rating_points_per_report_ok","3"))
-                            s.add(OrgRating(user_tg=c.from_user.id, delta_points=pts, reason=f"Отчёт: {it.label}"))
+                            pts = int(conf.get("rating_points_per_report_ok","3"))
+                            rows.append(OrgRating(user_tg=c.from_user.id, delta_points=pts, reason=f"Отчёт: {it.label}"))
                     else:
                         if it.required:
                             missed.append(it)
                 # штрафы за пропуски
                 for it in missed:
-                    pen = it.penalty_rub or int(self.get_settings(s).get("report_item_penalty_default","300"))
-                    s.add(OrgPenalty(user_tg=c.from_user.id, kind="report_miss", amount_rub=pen, reason=f"Не выполнен пункт: {it.label}"))
-                    pts = int(self.get_settings(s).get("rating_points_per_report_miss","-5"))
-                    s.add(OrgRating(user_tg=c.from_user.id, delta_points=pts, reason=f"Провал отчёта: {it.label}"))
+                    pen = it.penalty_rub or int(conf.get("report_item_penalty_default","300"))
+                    rows.append(OrgPenalty(user_tg=c.from_user.id, kind="report_miss", amount_rub=pen, reason=f"Не выполнен пункт: {it.label}"))
+                    pts = int(conf.get("rating_points_per_report_miss","-5"))
+                    rows.append(OrgRating(user_tg=c.from_user.id, delta_points=pts, reason=f"Провал отчёта: {it.label}"))
+                s.add_all(rows)
                 sub.is_complete = (len(missed)==0)
                 s.commit()
             bot.answer_callback_query(c.id)
             bot.send_message(c.message.chat.id, "Отчёт отправлен на проверку старшему/админу. Спасибо!")
-            SESS[c.from_user.id].clear()
+            SESS.pop(c.from_user.id, None)
 
         # ----------- МОЯ СТАТИСТИКА / АДМИН СТАТА -----------
         @bot.callback_query_handler(func=lambda c: c.data=="org_mystats")
         def my_stats(c):
             with self.SessionLocal() as s:
-                month_start = datetime(now_utc().year, now_utc().month, 1)
+                month_start = now_utc().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
                 pts = s.query(func.coalesce(func.sum(OrgRating.delta_points),0)).filter(OrgRating.user_tg==c.from_user.id, OrgRating.created_at>=month_start).scalar()
                 fines = s.query(func.coalesce(func.sum(OrgPenalty.amount_rub),0)).filter(OrgPenalty.user_tg==c.from_user.id, OrgPenalty.created_at>=month_start).scalar()
             bot.answer_callback_query(c.id)
@@ -832,13 +853,13 @@ class OrgExt:
 
         @bot.message_handler(func=lambda m: SESS.get(m.from_user.id,{}).get("stage")=="org_stats_user")
         def admin_stats_user(m: Message):
-            SESS[m.from_user.id].clear()
+            SESS.pop(m.from_user.id, None)
             try:
                 user_tg = int(m.text.replace("@","").strip()) if m.text.strip().isdigit() else m.from_user.id
             except:
                 user_tg = m.from_user.id
             with self.SessionLocal() as s:
-                month_start = datetime(now_utc().year, now_utc().month, 1)
+                month_start = now_utc().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
                 pts = s.query(func.coalesce(func.sum(OrgRating.delta_points),0)).filter(OrgRating.user_tg==user_tg, OrgRating.created_at>=month_start).scalar()
                 fines = s.query(func.coalesce(func.sum(OrgPenalty.amount_rub),0)).filter(OrgPenalty.user_tg==user_tg, OrgPenalty.created_at>=month_start).scalar()
             self.bot.reply_to(m, f"Статистика сотрудника {user_tg} за месяц:\nБаллы: {pts}\nШтрафы: {int(fines)} ₽")
@@ -850,5 +871,9 @@ class OrgExt:
             s.add(OrgUser(tg_id=tguser.id, full_name=(tguser.full_name or "").strip())); s.commit()
 
     def get_settings(self, s: Session) -> dict:
-        rows = s.query(OrgSetting).all()
-        return {r.key: r.value for r in rows}
+        cached = self._settings_cache
+        if cached and monotonic() - cached[0] < SETTINGS_TTL_SEC:
+            return cached[1]
+        conf = {k: v for k, v in s.query(OrgSetting.key, OrgSetting.value)}
+        self._settings_cache = (monotonic(), conf)
+        return conf